@@ -1,22 +1,58 @@
 # stores_dashboard.py - Navrongo Health Research Centre Store Management System
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import numpy as np
+import base64
+import bisect
 import hashlib
+import hmac
+import httpx
+import io
+import json
+import random
+import re
+import secrets
 import warnings
-from supabase import create_client, Client
+from postgrest.exceptions import APIError
+from supabase import create_client, Client, ClientOptions
+import openpyxl
 import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 warnings.filterwarnings('ignore')
 
+# Copy-on-write lets every session share one physical copy of each cached table:
+# views are cheap, and a session that modifies its view copies only what it touches
+pd.set_option("mode.copy_on_write", True)
+
 # Load environment variables
 load_dotenv()
 
-# ========== SUPABASE CONFIGURATION ==========
+# ========== DATABASE CONFIGURATION ==========
+def get_setting(name, default=None):
+    """Read a setting from Streamlit secrets, falling back to environment variables"""
+    try:
+        value = st.secrets.get(name)
+    except Exception:
+        value = None
+    if value is None:
+        value = os.getenv(name, default)
+    return value
+
 @st.cache_resource
 def init_supabase():
     """Initialize Supabase client"""
@@ -27,20 +63,534 @@ def init_supabase():
         st.error("Supabase credentials not found. Please set SUPABASE_URL and SUPABASE_KEY in secrets or environment variables.")
         st.stop()
     
-    return create_client(url, key)
+    client = create_client(url, key, options=ClientOptions(
+        postgrest_client_timeout=httpx.Timeout(float(get_setting("SMIS_HTTP_TIMEOUT", 10)), connect=5.0)
+    ))
+    # Replace the default PostgREST session with one that keeps idle connections
+    # alive between reruns (httpx drops them after 5s, so every click on a slow
+    # link paid for a new TLS handshake) and retries failed connects, which never
+    # reach the server and so are safe for writes too
+    session = client.postgrest.session
+    client.postgrest.session = httpx.Client(
+        base_url=session.base_url,
+        headers=session.headers,
+        timeout=session.timeout,
+        follow_redirects=True,
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10,
+                                keepalive_expiry=float(get_setting("SMIS_HTTP_KEEPALIVE", 120)))
+        )
+    )
+    session.close()
+    return client
 
-supabase = init_supabase()
+# ========== REFERENCE DATA ==========
+ITEM_CATEGORIES = ["Stationery", "Comp/Printer/Accessories", "Miscellaneous", 
+                   "Electrical Items", "Motor Parts", "Vehicle Parts - Toyota Hilux",
+                   "Fuel & Lubricants", "Laboratory Items", "Medical Supplies", "Office Equipment"]
+ITEM_UNITS = ["Units", "Pieces", "Reams", "Packets", "Boxes", 
+              "Bottles", "Litre", "Gallon", "Pairs", "Tin", "Rolls", "Cartons"]
+STORAGE_LOCATIONS = ["Main Store", "Lab A", "Lab B", "Cold Room", "Quarantine", "Archive", "Warehouse"]
 
 # ========== DATABASE OPERATIONS ==========
-class DatabaseManager:
-    def __init__(self, supabase_client):
+class BackendUnavailable(Exception):
+    """The backend could not be reached; the write may or may not have been applied"""
+
+
+class StorageBackend:
+    """Interface shared by the Supabase and SQLite storage backends"""
+    # Backend name shown in System Info
+    NAME = None
+    # Ledger table each stock movement kind is recorded in
+    LEDGERS = {'receipt': 'receipts', 'issue': 'issues'}
+    # Keyset columns (sort column, unique tie-breaker) for the movement ledgers
+    KEYSETS = {
+        'receipts': ('date', 'id'),
+        'issues': ('date', 'id'),
+    }
+    # Columns shown by the history tabs; everything else stays in the database
+    HISTORY_COLUMNS = {
+        'receipts': 'id,date,item_id,item_name,supplier,quantity,unit_cost,total_value,'
+                    'project_code,reference,received_by,notes',
+        'issues': 'id,date,item_id,item_name,department,quantity,purpose,issued_by,notes',
+    }
+    # Columns served by the paged inventory grid, and those its search box matches
+    GRID_COLUMNS = ['item_id', 'item_name', 'category', 'quantity', 'unit', 'storage_location', 'expiry_date']
+    GRID_SEARCH_COLUMNS = ['item_id', 'item_name', 'supplier', 'notes']
+    # High-water-mark column and primary key used for incremental sync
+    SYNC_SPECS = {
+        'inventory': ('updated_at', 'item_id'),
+        'receipts': ('created_at', 'id'),
+        'issues': ('created_at', 'id'),
+    }
+    # Compact in-memory dtypes applied to loaded frames: low-cardinality text as
+    # category, counts as int32, money as float64, dates (naive) and timestamps (UTC) parsed
+    DTYPES = {
+        'inventory': {'category': 'category', 'unit': 'category', 'storage_location': 'category',
+                      'supplier': 'category', 'quantity': 'int32', 'reorder_level': 'int32',
+                      'expiry_date': 'date', 'updated_at': 'timestamp'},
+        'receipts': {'supplier': 'category', 'project_code': 'category', 'quantity': 'int32',
+                     'unit_cost': 'float64', 'total_value': 'float64', 'date': 'date', 'recorded_at': 'timestamp',
+                     'created_at': 'timestamp'},
+        'issues': {'department': 'category', 'quantity': 'int32', 'date': 'date', 'recorded_at': 'timestamp',
+                   'created_at': 'timestamp'},
+    }
+    
+    @classmethod
+    def apply_schema(cls, table, frame):
+        """Coerce a loaded frame to the table's declared compact dtypes"""
+        if frame.empty:
+            return frame
+        frame = frame.copy(deep=False)
+        for col, dtype in cls.DTYPES.get(table, {}).items():
+            if col not in frame.columns:
+                continue
+            if dtype == 'category':
+                frame[col] = frame[col].astype('category')
+            elif dtype == 'int32':
+                values = pd.to_numeric(frame[col], errors='coerce')
+                # Columns with blanks stay float; int32 cannot hold NaN
+                frame[col] = values if values.isna().any() else values.astype('int32')
+            elif dtype == 'float64':
+                frame[col] = pd.to_numeric(frame[col], errors='coerce').astype('float64')
+            elif dtype == 'date':
+                frame[col] = pd.to_datetime(frame[col], errors='coerce', format='ISO8601')
+            elif dtype == 'timestamp':
+                frame[col] = pd.to_datetime(frame[col], errors='coerce', format='ISO8601', utc=True)
+        return frame
+    
+    # Change tracking
+    def get_changes(self, table, since):
+        """Get rows of a synced table changed at or after the given high-water mark"""
+        raise NotImplementedError
+    
+    # Export operations
+    def iter_table(self, table):
+        """Yield a whole synced table one frame at a time, for exports"""
+        loaders = {'inventory': self.get_inventory, 'receipts': self.get_receipts, 'issues': self.get_issues}
+        frame = loaders[table]()
+        if not frame.empty:
+            yield frame
+    
+    # User operations
+    def get_users(self):
+        """Get all users"""
+        raise NotImplementedError
+    
+    def get_user(self, username):
+        """Get user by username"""
+        raise NotImplementedError
+    
+    def has_users(self):
+        """Whether any user exists; None if the backend could not be asked"""
+        raise NotImplementedError
+    
+    def create_user(self, user_data):
+        """Create new user"""
+        raise NotImplementedError
+    
+    def upsert_users(self, users):
+        """Insert or update a batch of users keyed by username"""
+        raise NotImplementedError
+    
+    def update_user(self, username, updates):
+        """Update user"""
+        raise NotImplementedError
+    
+    def delete_user(self, username):
+        """Delete user"""
+        raise NotImplementedError
+    
+    # Session operations
+    def revoke_session(self, token_id, expires_at):
+        """Record a signed-out session token so no server process resumes it before it expires"""
+        raise NotImplementedError
+    
+    def is_session_revoked(self, token_id):
+        """Whether a session token was signed out; None if the backend could not be asked"""
+        raise NotImplementedError
+    
+    # Inventory operations
+    def get_inventory(self):
+        """Get all inventory items"""
+        raise NotImplementedError
+    
+    def search_inventory(self, query, limit=50):
+        """Get up to ``limit`` inventory items whose name or ID contains ``query``"""
+        raise NotImplementedError
+    
+    def create_inventory_item(self, item_data):
+        """Create new inventory item"""
+        raise NotImplementedError
+    
+    def upsert_inventory_items(self, items):
+        """Insert or update a batch of inventory items keyed by item_id"""
+        raise NotImplementedError
+    
+    def update_inventory_item(self, item_id, updates):
+        """Update inventory item"""
+        raise NotImplementedError
+    
+    def delete_inventory_item(self, item_id):
+        """Delete inventory item"""
+        raise NotImplementedError
+    
+    def allocate_id_block(self, prefix, count):
+        """Reserve ``count`` consecutive numbers for item IDs starting with ``prefix``; returns (True, first number)"""
+        raise NotImplementedError
+    
+    # Receipts operations
+    def get_receipts(self):
+        """Get all receipts"""
+        raise NotImplementedError
+    
+    def get_receipts_between(self, start_date, end_date, columns=None):
+        """Get receipts dated within [start_date, end_date], newest first"""
+        raise NotImplementedError
+    
+    def create_receipt(self, receipt_data):
+        """Create new receipt"""
+        raise NotImplementedError
+    
+    # Issues operations
+    def get_issues(self):
+        """Get all issues"""
+        raise NotImplementedError
+    
+    def get_issues_between(self, start_date, end_date, columns=None):
+        """Get issues dated within [start_date, end_date], newest first"""
+        raise NotImplementedError
+    
+    def create_issue(self, issue_data):
+        """Create new issue"""
+        raise NotImplementedError
+    
+    # Stock movement operations
+    def record_stock_movements(self, kind, entries, username):
+        """Apply a multi-line receipt or issue voucher in one transaction with a bulk ledger insert"""
+        # Lines carrying a client_ref that is already in the ledger must be skipped,
+        # so replaying a voucher whose outcome was unknown never double-counts it
+        raise NotImplementedError
+    
+    # Diagnostics
+    def get_transport_stats(self):
+        """Get call counts, retries, failures and latency percentiles per operation"""
+        return pd.DataFrame()
+    
+    # Aggregate operations; backends override these with server-side versions
+    def get_inventory_kpis(self, fallback=None):
+        """Get dashboard KPIs; ``fallback`` supplies the inventory frame if no server-side version exists"""
+        return self.compute_inventory_kpis(fallback() if fallback else self.get_inventory())
+    
+    def get_category_totals(self, fallback=None):
+        """Get units and item counts per category"""
+        return self.compute_category_totals(fallback() if fallback else self.get_inventory())
+    
+    def get_low_stock_items(self, fallback=None):
+        """Get items at or below their reorder level"""
+        inventory_df = fallback() if fallback else self.get_inventory()
+        if inventory_df.empty or 'reorder_level' not in inventory_df.columns:
+            return pd.DataFrame()
+        low_stock = inventory_df[inventory_df['quantity'] <= inventory_df['reorder_level']]
+        return low_stock[[col for col in ['item_name', 'category', 'quantity', 'unit', 'reorder_level']
+                          if col in low_stock.columns]]
+    
+    def get_inventory_page(self, filters, sort, descending, offset, limit, count='exact', fallback=None):
+        """Get one sorted page of the inventory grid and the number of rows matching ``filters``"""
+        inventory_df = fallback() if fallback else enrich_inventory(self.get_inventory())
+        return self.compute_inventory_page(inventory_df, filters, sort, descending, offset, limit)
+    
+    def iter_inventory_grid(self, filters, sort, descending, fallback=None):
+        """Yield every inventory grid row matching ``filters`` in grid order, one page frame at a time"""
+        inventory_df = fallback() if fallback else enrich_inventory(self.get_inventory())
+        matched, total = self.compute_inventory_page(inventory_df, filters, sort, descending, 0, None)
+        if total:
+            yield matched
+    
+    def get_movement_totals(self, fallback=None):
+        """Get total units and row counts for receipts and issues"""
+        receipts_df, issues_df = fallback() if fallback else (self.get_receipts(), self.get_issues())
+        return self.compute_movement_totals(receipts_df, issues_df)
+    
+    @staticmethod
+    def compute_inventory_kpis(inventory_df):
+        """Compute dashboard KPIs from an inventory frame"""
+        kpis = {'total_items': len(inventory_df), 'total_units': 0, 'low_stock': 0,
+                'expired': 0, 'expiring_30': 0, 'categories': 0}
+        if inventory_df.empty:
+            return kpis
+        if 'quantity' in inventory_df.columns:
+            kpis['total_units'] = int(inventory_df['quantity'].sum())
+            if 'reorder_level' in inventory_df.columns:
+                kpis['low_stock'] = int(((inventory_df['quantity'] <= inventory_df['reorder_level']) &
+                                         (inventory_df['quantity'] > 0)).sum())
+        if 'expiry_date' in inventory_df.columns:
+            # Frames from the table cache already carry days_to_expiry
+            days_to_expiry = inventory_df.get('days_to_expiry')
+            if days_to_expiry is None:
+                days_to_expiry = (pd.to_datetime(inventory_df['expiry_date'], errors='coerce') - pd.Timestamp.now()).dt.days
+            kpis['expired'] = int((days_to_expiry <= 0).sum())
+            kpis['expiring_30'] = int(((days_to_expiry > 0) & (days_to_expiry <= 30)).sum())
+        if 'category' in inventory_df.columns:
+            kpis['categories'] = int(inventory_df['category'].nunique())
+        return kpis
+    
+    @staticmethod
+    def compute_category_totals(inventory_df):
+        """Compute units and item counts per category from an inventory frame"""
+        if inventory_df.empty or not {'category', 'quantity'} <= set(inventory_df.columns):
+            return pd.DataFrame(columns=['category', 'quantity', 'items'])
+        return (inventory_df.groupby('category', observed=True)
+                .agg(quantity=('quantity', 'sum'), items=('quantity', 'size'))
+                .reset_index())
+    
+    @classmethod
+    def compute_inventory_page(cls, inventory_df, filters, sort, descending, offset, limit):
+        """Filter, sort and slice an enriched inventory frame; returns (page, total)"""
+        if inventory_df.empty:
+            return pd.DataFrame(columns=cls.GRID_COLUMNS), 0
+        
+        mask = pd.Series(True, index=inventory_df.index)
+        for column, value in filters.items():
+            if column == 'search':
+                hits = pd.Series(False, index=inventory_df.index)
+                for search_col in cls.GRID_SEARCH_COLUMNS:
+                    if search_col in inventory_df.columns:
+                        hits |= inventory_df[search_col].astype('string').str.contains(
+                            value, case=False, regex=False, na=False)
+                mask &= hits
+            elif column in inventory_df.columns:
+                mask &= inventory_df[column].isin(value if isinstance(value, (list, tuple)) else [value])
+        filtered = inventory_df[mask]
+        
+        # Same order as the database: item_id breaks ties, and nulls sort as PostgreSQL puts them
+        if sort in filtered.columns:
+            sort_cols = [sort] if sort == 'item_id' else [sort, 'item_id']
+            filtered = filtered.sort_values(sort_cols, ascending=not descending, kind='stable',
+                                            na_position='first' if descending else 'last')
+        page = filtered.iloc[offset:None if limit is None else offset + limit]
+        return page[[col for col in cls.GRID_COLUMNS if col in page.columns]], len(filtered)
+    
+    @staticmethod
+    def compute_movement_totals(receipts_df, issues_df):
+        """Compute receipt and issue totals from the ledger frames"""
+        return {
+            'total_received': int(receipts_df['quantity'].sum()) if 'quantity' in receipts_df.columns else 0,
+            'total_issued': int(issues_df['quantity'].sum()) if 'quantity' in issues_df.columns else 0,
+            'receipt_count': len(receipts_df),
+            'issue_count': len(issues_df),
+        }
+
+class DeadlineSession:
+    """Session wrapper that caps the timeout of every request sent through it"""
+    def __init__(self, session, timeout):
+        self.session = session
+        self.timeout = timeout
+        # HTTP status of the last response; postgrest-py drops it from the errors it raises
+        self.status_code = None
+    
+    def request(self, *args, **kwargs):
+        response = self.session.request(*args, timeout=self.timeout, **kwargs)
+        self.status_code = response.status_code
+        return response
+
+
+class DatabaseManager(StorageBackend):
+    """Supabase (PostgREST) storage backend"""
+    NAME = "Supabase (PostgreSQL)"
+    # Rows per request; keep at or below the PostgREST max-rows setting
+    PAGE_SIZE = 1000
+    # Upper bound on the memory a single assembled table frame may use
+    MAX_FRAME_MB = 256
+    # Total seconds an operation may take, retries included
+    DEADLINES = {'read': 20.0, 'write': 30.0}
+    # Extra attempts for reads, with full-jitter exponential backoff from RETRY_BACKOFF seconds
+    READ_RETRIES = 3
+    RETRY_BACKOFF = 0.25
+    # Gateway HTTP statuses and PostgREST "database unreachable" codes worth retrying
+    TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+    TRANSIENT_CODES = {'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003'}
+    # Warning shown when a table outgrows the frame memory cap, per table
+    TRUNCATION_WARNINGS = {
+        'inventory': "Inventory only partly loaded: the first {rows:,} items fit the memory cap ({cap:g} MB). "
+                     "Item searches go to the database; raise SMIS_MAX_FRAME_MB to load every item.",
+        'receipts': "Receipts history truncated at {rows:,} rows (memory cap {cap:g} MB).",
+        'issues': "Issues history truncated at {rows:,} rows (memory cap {cap:g} MB).",
+    }
+    # Latency samples kept per operation
+    LATENCY_WINDOW = 200
+    
+    def __init__(self, supabase_client, page_size=None, max_frame_mb=None):
         self.supabase = supabase_client
+        self.page_size = int(page_size or get_setting("SMIS_PAGE_SIZE", self.PAGE_SIZE))
+        self.max_frame_mb = float(max_frame_mb or get_setting("SMIS_MAX_FRAME_MB", self.MAX_FRAME_MB))
+        self.deadlines = {kind: float(get_setting(f"SMIS_{kind.upper()}_DEADLINE", seconds))
+                          for kind, seconds in self.DEADLINES.items()}
+        self.read_retries = int(get_setting("SMIS_READ_RETRIES", self.READ_RETRIES))
+        self.attempt_timeout = float(get_setting("SMIS_HTTP_TIMEOUT", 10))
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+    
+    # Transport helpers
+    @classmethod
+    def is_transient(cls, error):
+        """Whether a failed request may succeed if simply sent again"""
+        if isinstance(error, httpx.TransportError):
+            return True
+        if not isinstance(error, APIError):
+            return False
+        # The gateway answers 429/502/503/504 with a bare {"message": ...} body and no code
+        return (getattr(error, 'status_code', None) in cls.TRANSIENT_STATUSES
+                or str(error.code) in cls.TRANSIENT_CODES)
+    
+    def _execute(self, query, operation, idempotent=False):
+        """Execute a PostgREST request within its deadline, retrying idempotent ones on transient errors"""
+        deadline = time.monotonic() + self.deadlines['read' if idempotent else 'write']
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            remaining = deadline - started
+            # Reads keep some budget back for a retry; a write gets the whole budget in one attempt
+            timeout = min(remaining, self.attempt_timeout) if idempotent else remaining
+            query.session = DeadlineSession(getattr(query.session, 'session', query.session),
+                                            httpx.Timeout(timeout, connect=min(timeout, 5.0)))
+            try:
+                response = query.execute()
+            except Exception as e:
+                if isinstance(e, APIError):
+                    # Kept on the error so callers can tell an outage from a rejected request
+                    e.status_code = query.session.status_code
+                self._account(operation, time.monotonic() - started, failed=True)
+                delay = random.uniform(0, self.RETRY_BACKOFF * 2 ** attempt)
+                if (not idempotent or not self.is_transient(e) or attempt >= self.read_retries
+                        or time.monotonic() + delay >= deadline):
+                    raise
+                attempt += 1
+                self._account(operation, retried=True)
+                time.sleep(delay)
+            else:
+                self._account(operation, time.monotonic() - started)
+                return response
+    
+    def _account(self, operation, elapsed=None, failed=False, retried=False):
+        with self._stats_lock:
+            stats = self._stats.setdefault(operation, {
+                'calls': 0, 'retries': 0, 'failures': 0, 'latency': deque(maxlen=self.LATENCY_WINDOW)
+            })
+            if retried:
+                stats['retries'] += 1
+                return
+            stats['calls'] += 1
+            stats['failures'] += failed
+            stats['latency'].append(elapsed)
+    
+    def get_transport_stats(self):
+        """Get call counts, retries, failures and latency percentiles per operation"""
+        with self._stats_lock:
+            rows = [{'operation': operation, 'calls': stats['calls'], 'retries': stats['retries'],
+                     'failures': stats['failures'], 'latency': list(stats['latency'])}
+                    for operation, stats in self._stats.items()]
+        if not rows:
+            return pd.DataFrame()
+        stats = pd.DataFrame(rows)
+        latency_ms = stats.pop('latency').apply(lambda samples: np.array(samples) * 1000)
+        stats['p50_ms'] = latency_ms.apply(lambda ms: np.percentile(ms, 50)).round(0)
+        stats['p95_ms'] = latency_ms.apply(lambda ms: np.percentile(ms, 95)).round(0)
+        stats['max_ms'] = latency_ms.apply(np.max).round(0)
+        return stats.sort_values('operation', ignore_index=True)
+    
+    # Paged fetch helpers
+    def iter_pages(self, table, columns='*', keyset=None, order_by=None, page_size=None, where=None,
+                   descending=False):
+        """Yield a table page by page instead of in one unbounded request"""
+        # With a keyset (sort column, tie-breaker) pages are walked newest first
+        # via (sort, tie) < (last_sort, last_tie), which stays cheap on deep pages.
+        # Without one, plain range() offsets ordered by order_by (a column or a
+        # list of them) are used. Each where entry is (method, *args) on the query.
+        page_size = page_size or self.page_size
+        order_by = [order_by] if isinstance(order_by, str) else order_by or []
+        last = None
+        offset = 0
+        while True:
+            query = self.supabase.table(table).select(columns)
+            for op, *args in where or ():
+                query = getattr(query, op)(*args)
+            if keyset:
+                sort_col, tie_col = keyset
+                query = query.order(sort_col, desc=True).order(tie_col, desc=True)
+                if last is not None:
+                    query = query.or_(
+                        f'{sort_col}.lt."{last[0]}",'
+                        f'and({sort_col}.eq."{last[0]}",{tie_col}.lt."{last[1]}")'
+                    )
+                query = query.range(0, page_size - 1)
+            else:
+                for column in order_by:
+                    query = query.order(column, desc=descending)
+                query = query.range(offset, offset + page_size - 1)
+            
+            rows = self._execute(query, f"select {table}", idempotent=True).data or []
+            if not rows:
+                break
+            yield rows
+            if len(rows) < page_size:
+                break
+            
+            if keyset:
+                last = (rows[-1][keyset[0]], rows[-1][keyset[1]])
+            offset += len(rows)
+    
+    def iter_table(self, table):
+        """Yield a whole synced table one page frame at a time, for exports"""
+        if table in self.KEYSETS:
+            pages = self.iter_pages(table, keyset=self.KEYSETS[table])
+        else:
+            pages = self.iter_pages(table, order_by=self.SYNC_SPECS[table][1])
+        for rows in pages:
+            yield pd.DataFrame(rows)
+    
+    def fetch_table(self, table, columns='*', keyset=None, order_by=None, where=None):
+        """Assemble a DataFrame from streamed pages, bounded by ``max_frame_mb``"""
+        frames = []
+        used_bytes = 0
+        limit_bytes = self.max_frame_mb * 1024 * 1024
+        truncated = False
+        for rows in self.iter_pages(table, columns, keyset=keyset, order_by=order_by, where=where):
+            # Convert each page straight away so only one page of raw dicts is alive
+            frame = pd.DataFrame(rows)
+            frames.append(frame)
+            used_bytes += frame.memory_usage(deep=True).sum()
+            if used_bytes >= limit_bytes:
+                st.warning(self.TRUNCATION_WARNINGS.get(
+                    table, f"{table.title()} truncated at {{rows:,}} rows (memory cap {{cap:g}} MB)."
+                ).format(rows=sum(len(f) for f in frames), cap=self.max_frame_mb))
+                truncated = True
+                break
+        if not frames:
+            return pd.DataFrame()
+        frame = pd.concat(frames, ignore_index=True)
+        # Lets the table cache tell a partial table from a complete one
+        frame.attrs['truncated'] = truncated
+        return frame
+    
+    def get_changes(self, table, since):
+        """Get rows of a synced table changed at or after the given high-water mark"""
+        mark_col, key = self.SYNC_SPECS[table]
+        try:
+            # Vouchers and imports stamp many rows with one time; the key makes the
+            # order total, so offset pages neither skip nor repeat rows sharing it
+            return self.fetch_table(table, order_by=[mark_col, key], where=[('gte', mark_col, since)])
+        except Exception as e:
+            st.error(f"Error syncing {table}: {e}")
+            return pd.DataFrame()
     
     # User operations
     def get_users(self):
         """Get all users"""
         try:
-            response = self.supabase.table('users').select('*').execute()
+            response = self._execute(self.supabase.table('users').select('*'), "select users", idempotent=True)
             if response.data:
                 return pd.DataFrame(response.data)
             return pd.DataFrame()
@@ -51,7 +601,8 @@ class DatabaseManager:
     def get_user(self, username):
         """Get user by username"""
         try:
-            response = self.supabase.table('users').select('*').eq('username', username).execute()
+            response = self._execute(self.supabase.table('users').select('*').eq('username', username),
+                                     "select users", idempotent=True)
             if response.data:
                 return response.data[0]
             return None
@@ -59,10 +610,29 @@ class DatabaseManager:
             st.error(f"Error fetching user: {e}")
             return None
     
+    def has_users(self):
+        """Whether any user exists; None if the backend could not be asked"""
+        try:
+            response = self._execute(self.supabase.table('users').select('username').limit(1),
+                                     "select users", idempotent=True)
+            return bool(response.data)
+        except Exception as e:
+            st.error(f"Error checking users: {e}")
+            return None
+    
     def create_user(self, user_data):
         """Create new user"""
         try:
-            response = self.supabase.table('users').insert(user_data).execute()
+            response = self._execute(self.supabase.table('users').insert(user_data), "insert users")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    def upsert_users(self, users):
+        """Insert or update a batch of users keyed by username"""
+        try:
+            response = self._execute(self.supabase.table('users').upsert(users, on_conflict='username'),
+                                     "upsert users")
             return True, response.data
         except Exception as e:
             return False, str(e)
@@ -70,104 +640,1400 @@ class DatabaseManager:
     def update_user(self, username, updates):
         """Update user"""
         try:
-            response = self.supabase.table('users').update(updates).eq('username', username).execute()
+            response = self._execute(self.supabase.table('users').update(updates).eq('username', username),
+                                     "update users")
             return True, response.data
         except Exception as e:
             return False, str(e)
     
-    def delete_user(self, username):
-        """Delete user"""
-        try:
-            response = self.supabase.table('users').delete().eq('username', username).execute()
-            return True, response.data
-        except Exception as e:
-            return False, str(e)
+    def delete_user(self, username):
+        """Delete user"""
+        try:
+            response = self._execute(self.supabase.table('users').delete().eq('username', username),
+                                     "delete users")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    # Session operations
+    def revoke_session(self, token_id, expires_at):
+        """Record a signed-out session token so no server process resumes it before it expires"""
+        try:
+            # Tokens past their expiry are rejected anyway, so their rows can go
+            self._execute(self.supabase.table('revoked_sessions').delete().lt('expires_at', int(time.time())),
+                          "delete revoked_sessions", idempotent=True)
+            response = self._execute(
+                self.supabase.table('revoked_sessions').upsert(
+                    {'token_id': token_id, 'expires_at': int(expires_at)}, on_conflict='token_id'),
+                "upsert revoked_sessions", idempotent=True)
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    def is_session_revoked(self, token_id):
+        """Whether a session token was signed out; None if the backend could not be asked"""
+        try:
+            response = self._execute(
+                self.supabase.table('revoked_sessions').select('token_id').eq('token_id', token_id).limit(1),
+                "select revoked_sessions", idempotent=True)
+            return bool(response.data)
+        except Exception as e:
+            st.error(f"Error checking session: {e}")
+            return None
+    
+    # Inventory operations
+    def get_inventory(self):
+        """Get all inventory items"""
+        try:
+            return self.fetch_table('inventory', order_by='item_id')
+        except Exception as e:
+            st.error(f"Error fetching inventory: {e}")
+            return pd.DataFrame()
+    
+    def search_inventory(self, query, limit=50):
+        """Get up to ``limit`` inventory items whose name or ID contains ``query``"""
+        # Characters with a meaning in PostgREST filter syntax cannot be escaped inside or=()
+        term = re.sub(r'[,()*%"\\]', ' ', query).strip()
+        if not term:
+            return pd.DataFrame()
+        try:
+            response = self._execute(
+                self.supabase.table('inventory').select('*')
+                .or_(f'item_name.ilike."*{term}*",item_id.ilike."*{term}*"')
+                .order('item_name').limit(limit),
+                "search inventory", idempotent=True
+            )
+            return pd.DataFrame(response.data)
+        except Exception as e:
+            st.error(f"Error searching inventory: {e}")
+            return pd.DataFrame()
+    
+    def create_inventory_item(self, item_data):
+        """Create new inventory item"""
+        try:
+            response = self._execute(self.supabase.table('inventory').insert(item_data), "insert inventory")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    def upsert_inventory_items(self, items):
+        """Insert or update a batch of inventory items keyed by item_id"""
+        try:
+            response = self._execute(self.supabase.table('inventory').upsert(items, on_conflict='item_id'),
+                                     "upsert inventory")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    def update_inventory_item(self, item_id, updates):
+        """Update inventory item"""
+        try:
+            response = self._execute(self.supabase.table('inventory').update(updates).eq('item_id', item_id),
+                                     "update inventory")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    def delete_inventory_item(self, item_id):
+        """Delete inventory item"""
+        try:
+            response = self._execute(self.supabase.table('inventory').delete().eq('item_id', item_id),
+                                     "delete inventory")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    def allocate_id_block(self, prefix, count):
+        """Reserve ``count`` consecutive numbers for item IDs starting with ``prefix``; returns (True, first number)"""
+        try:
+            # Not retried: a lost response only leaves a gap, a replay would reserve a second block
+            response = self._execute(self.supabase.rpc('allocate_id_block', {'p_prefix': prefix, 'p_count': int(count)}),
+                                     "rpc allocate_id_block")
+            return True, int(response.data)
+        except Exception as e:
+            return False, str(e)
+    
+    # Receipts operations
+    def get_receipts(self):
+        """Get all receipts"""
+        try:
+            return self.fetch_table('receipts', keyset=self.KEYSETS['receipts'])
+        except Exception as e:
+            st.error(f"Error fetching receipts: {e}")
+            return pd.DataFrame()
+    
+    def get_receipts_between(self, start_date, end_date, columns=None):
+        """Get receipts dated within [start_date, end_date], newest first"""
+        try:
+            return self.fetch_table(
+                'receipts',
+                columns or self.HISTORY_COLUMNS['receipts'],
+                keyset=self.KEYSETS['receipts'],
+                where=[('gte', 'date', start_date.isoformat()), ('lte', 'date', end_date.isoformat())]
+            )
+        except Exception as e:
+            st.error(f"Error fetching receipts: {e}")
+            return pd.DataFrame()
+    
+    def create_receipt(self, receipt_data):
+        """Create new receipt"""
+        try:
+            response = self._execute(self.supabase.table('receipts').insert(receipt_data), "insert receipts")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    # Issues operations
+    def get_issues(self):
+        """Get all issues"""
+        try:
+            return self.fetch_table('issues', keyset=self.KEYSETS['issues'])
+        except Exception as e:
+            st.error(f"Error fetching issues: {e}")
+            return pd.DataFrame()
+    
+    def get_issues_between(self, start_date, end_date, columns=None):
+        """Get issues dated within [start_date, end_date], newest first"""
+        try:
+            return self.fetch_table(
+                'issues',
+                columns or self.HISTORY_COLUMNS['issues'],
+                keyset=self.KEYSETS['issues'],
+                where=[('gte', 'date', start_date.isoformat()), ('lte', 'date', end_date.isoformat())]
+            )
+        except Exception as e:
+            st.error(f"Error fetching issues: {e}")
+            return pd.DataFrame()
+    
+    def create_issue(self, issue_data):
+        """Create new issue"""
+        try:
+            response = self._execute(self.supabase.table('issues').insert(issue_data), "insert issues")
+            return True, response.data
+        except Exception as e:
+            return False, str(e)
+    
+    # Stock movement operations (function in sql/stock_movements.sql)
+    def record_stock_movements(self, kind, entries, username):
+        """Apply a multi-line receipt or issue voucher in one transaction with a bulk ledger insert"""
+        try:
+            response = self._execute(self.supabase.rpc('record_stock_movements', {
+                'p_kind': kind,
+                'p_entries': entries,
+                'p_user': username
+            }), "rpc record_stock_movements")
+            return True, response.data
+        except Exception as e:
+            if self.is_transient(e):
+                return False, BackendUnavailable(str(e))
+            return False, str(e)
+    
+    # Aggregate operations (views in sql/aggregates.sql, pandas fallback otherwise)
+    def get_inventory_kpis(self, fallback=None):
+        """Get dashboard KPIs; ``fallback`` supplies the inventory frame if the view is missing"""
+        try:
+            response = self._execute(self.supabase.table('inventory_kpis').select('*'),
+                                     "select inventory_kpis", idempotent=True)
+            if response.data:
+                return {key: int(value or 0) for key, value in response.data[0].items()}
+        except Exception:
+            pass
+        return super().get_inventory_kpis(fallback)
+    
+    def get_category_totals(self, fallback=None):
+        """Get units and item counts per category"""
+        try:
+            response = self._execute(self.supabase.table('inventory_category_totals').select('*'),
+                                     "select inventory_category_totals", idempotent=True)
+            return pd.DataFrame(response.data, columns=['category', 'quantity', 'items'])
+        except Exception:
+            return super().get_category_totals(fallback)
+    
+    def get_low_stock_items(self, fallback=None):
+        """Get items at or below their reorder level"""
+        try:
+            response = self._execute(self.supabase.table('inventory_low_stock').select('*'),
+                                     "select inventory_low_stock", idempotent=True)
+            return pd.DataFrame(response.data, columns=['item_name', 'category', 'quantity', 'unit', 'reorder_level'])
+        except Exception:
+            return super().get_low_stock_items(fallback)
+    
+    def _grid_conditions(self, filters):
+        # Grid filters as (query method, *args) pairs, shared by paging and export
+        conditions = []
+        for column, value in filters.items():
+            if column == 'search':
+                term = re.sub(r'[,()*%"\\]', ' ', value).strip()
+                conditions.append(('or_', ','.join(f'{col}.ilike."*{term}*"' for col in self.GRID_SEARCH_COLUMNS)))
+            elif isinstance(value, (list, tuple)):
+                conditions.append(('in_', column, list(value)))
+            else:
+                conditions.append(('eq', column, value))
+        return conditions
+    
+    def get_inventory_page(self, filters, sort, descending, offset, limit, count='exact', fallback=None):
+        """Get one sorted page of the inventory grid and the number of rows matching ``filters``"""
+        try:
+            query = self.supabase.table('inventory_grid').select(','.join(self.GRID_COLUMNS), count=count)
+            for op, *args in self._grid_conditions(filters):
+                query = getattr(query, op)(*args)
+            query = query.order(sort, desc=descending)
+            if sort != 'item_id':
+                query = query.order('item_id', desc=descending)
+            response = self._execute(query.range(offset, offset + limit - 1), "select inventory_grid", idempotent=True)
+            return pd.DataFrame(response.data, columns=self.GRID_COLUMNS), response.count or 0
+        except Exception:
+            return super().get_inventory_page(filters, sort, descending, offset, limit, count, fallback)
+    
+    def iter_inventory_grid(self, filters, sort, descending, fallback=None):
+        """Yield every inventory grid row matching ``filters`` in grid order, one page frame at a time"""
+        pages = self.iter_pages('inventory_grid', ','.join(self.GRID_COLUMNS),
+                                order_by=[sort] if sort == 'item_id' else [sort, 'item_id'],
+                                where=self._grid_conditions(filters), descending=descending)
+        try:
+            first = next(pages, None)
+        except Exception:
+            # Without the inventory_grid view the table is filtered locally, as for paging
+            yield from super().iter_inventory_grid(filters, sort, descending, fallback)
+            return
+        if first is None:
+            return
+        yield pd.DataFrame(first, columns=self.GRID_COLUMNS)
+        for rows in pages:
+            yield pd.DataFrame(rows, columns=self.GRID_COLUMNS)
+    
+    def get_movement_totals(self, fallback=None):
+        """Get total units and row counts for receipts and issues"""
+        try:
+            response = self._execute(self.supabase.table('movement_totals').select('*'),
+                                     "select movement_totals", idempotent=True)
+            if response.data:
+                return {key: int(value or 0) for key, value in response.data[0].items()}
+        except Exception:
+            pass
+        return super().get_movement_totals(fallback)
+
+# ========== LOCAL SQLITE ENGINE ==========
+class SQLiteDatabaseManager(StorageBackend):
+    """Local SQLite storage backend (WAL mode) for offline sites, profiling and tests"""
+    NAME = "SQLite (local)"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            full_name TEXT,
+            role TEXT,
+            department TEXT,
+            created_at TEXT,
+            created_by TEXT
+        );
+        CREATE TABLE IF NOT EXISTS inventory (
+            item_id TEXT PRIMARY KEY,
+            item_name TEXT NOT NULL,
+            category TEXT,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            unit TEXT,
+            storage_location TEXT,
+            reorder_level INTEGER,
+            supplier TEXT,
+            notes TEXT,
+            expiry_date TEXT,
+            created_date TEXT,
+            created_by TEXT,
+            updated_at TEXT,
+            updated_by TEXT
+        );
+        CREATE TABLE IF NOT EXISTS receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            item_name TEXT,
+            supplier TEXT,
+            quantity INTEGER NOT NULL,
+            unit_cost REAL,
+            total_value REAL,
+            project_code TEXT,
+            reference TEXT,
+            received_by TEXT,
+            notes TEXT,
+            client_ref TEXT,
+            recorded_at TEXT,
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS issues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            item_name TEXT,
+            department TEXT,
+            quantity INTEGER NOT NULL,
+            purpose TEXT,
+            issued_by TEXT,
+            notes TEXT,
+            client_ref TEXT,
+            recorded_at TEXT,
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS id_counters (
+            prefix TEXT PRIMARY KEY,
+            last_value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS revoked_sessions (
+            token_id TEXT PRIMARY KEY,
+            expires_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_inventory_item_name ON inventory (item_name);
+        CREATE INDEX IF NOT EXISTS idx_inventory_updated_at ON inventory (updated_at);
+        CREATE INDEX IF NOT EXISTS idx_receipts_item_id ON receipts (item_id);
+        CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts (date, id);
+        CREATE INDEX IF NOT EXISTS idx_receipts_created_at ON receipts (created_at);
+        CREATE INDEX IF NOT EXISTS idx_issues_item_id ON issues (item_id);
+        CREATE INDEX IF NOT EXISTS idx_issues_date ON issues (date, id);
+        CREATE INDEX IF NOT EXISTS idx_issues_created_at ON issues (created_at);
+    """
+    # Applied after MIGRATIONS so databases created before the column existed get it too
+    POST_MIGRATION_SCHEMA = """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_receipts_client_ref ON receipts (client_ref);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_issues_client_ref ON issues (client_ref);
+    """
+    MIGRATIONS = {
+        ('receipts', 'client_ref'): "ALTER TABLE receipts ADD COLUMN client_ref TEXT",
+        ('issues', 'client_ref'): "ALTER TABLE issues ADD COLUMN client_ref TEXT",
+        ('receipts', 'recorded_at'): "ALTER TABLE receipts ADD COLUMN recorded_at TEXT",
+        ('issues', 'recorded_at'): "ALTER TABLE issues ADD COLUMN recorded_at TEXT",
+    }
+    LEDGER_COLUMNS = {
+        'receipt': ('receipts', ['date', 'item_id', 'item_name', 'supplier', 'quantity', 'unit_cost',
+                                 'total_value', 'project_code', 'reference', 'received_by', 'notes',
+                                 'client_ref', 'recorded_at', 'created_at']),
+        'issue': ('issues', ['date', 'item_id', 'item_name', 'department', 'quantity', 'purpose',
+                             'issued_by', 'notes', 'client_ref', 'recorded_at', 'created_at']),
+    }
+    PRIMARY_KEYS = {'users': 'username', 'inventory': 'item_id', 'receipts': 'id', 'issues': 'id'}
+    
+    def __init__(self, path=':memory:'):
+        if path == ':memory:':
+            # A named shared-cache database lets every thread's connection see the same data
+            self.path, self.uri = f"file:smis-{id(self)}?mode=memory&cache=shared", True
+        else:
+            self.path, self.uri = path, False
+        self._local = threading.local()
+        # Keeps an in-memory database alive and owns the schema
+        self._anchor = self._connect()
+        self._anchor.execute("PRAGMA journal_mode=WAL")
+        self._anchor.executescript(self.SCHEMA)
+        for (table, column), statement in self.MIGRATIONS.items():
+            if column not in [row['name'] for row in self._anchor.execute(f"PRAGMA table_info({table})")]:
+                self._anchor.execute(statement)
+        self._anchor.executescript(self.POST_MIGRATION_SCHEMA)
+        self.columns = {table: [row['name'] for row in self._anchor.execute(f"PRAGMA table_info({table})")]
+                        for table in self.PRIMARY_KEYS}
+    
+    @property
+    def conn(self):
+        """Per-thread connection; WAL lets readers run alongside the single writer"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+    
+    def _connect(self):
+        # Autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, uri=self.uri, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    # Query helpers
+    def _query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.conn, params=params)
+    
+    def _check_columns(self, table, columns):
+        unknown = [col for col in columns if col not in self.columns[table]]
+        if unknown:
+            raise ValueError(f"Unknown column(s) for {table}: {', '.join(unknown)}")
+    
+    def _insert(self, table, rows, upsert=False):
+        rows = rows if isinstance(rows, list) else [rows]
+        if not rows:
+            return True, []
+        try:
+            columns = list(rows[0])
+            self._check_columns(table, columns)
+            key = self.PRIMARY_KEYS[table]
+            sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            if upsert:
+                updates = ', '.join(f"{col} = excluded.{col}" for col in columns if col != key)
+                sql += f" ON CONFLICT ({key}) DO UPDATE SET {updates}" if updates else f" ON CONFLICT ({key}) DO NOTHING"
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                if key == 'id':
+                    last_id = cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                cur.executemany(sql, [[row.get(col) for col in columns] for row in rows])
+                if key == 'id':
+                    written = cur.execute(f"SELECT * FROM {table} WHERE id > ? ORDER BY id", (last_id,))
+                else:
+                    keys = [row[key] for row in rows]
+                    written = cur.execute(f"SELECT * FROM {table} WHERE {key} IN ({', '.join('?' * len(keys))})", keys)
+                written = [dict(row) for row in written]
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            return True, written
+        except Exception as e:
+            return False, str(e)
+    
+    def _update(self, table, key_value, updates):
+        try:
+            self._check_columns(table, updates)
+            key = self.PRIMARY_KEYS[table]
+            assignments = ', '.join(f"{col} = ?" for col in updates)
+            self.conn.execute(f"UPDATE {table} SET {assignments} WHERE {key} = ?", [*updates.values(), key_value])
+            return True, self._query(f"SELECT * FROM {table} WHERE {key} = ?", (key_value,)).to_dict('records')
+        except Exception as e:
+            return False, str(e)
+    
+    def _delete(self, table, key_value):
+        try:
+            key = self.PRIMARY_KEYS[table]
+            deleted = self._query(f"SELECT * FROM {table} WHERE {key} = ?", (key_value,)).to_dict('records')
+            self.conn.execute(f"DELETE FROM {table} WHERE {key} = ?", (key_value,))
+            return True, deleted
+        except Exception as e:
+            return False, str(e)
+    
+    def _history(self, table, start_date, end_date, columns):
+        columns = [col.strip() for col in (columns or self.HISTORY_COLUMNS[table]).split(',')]
+        self._check_columns(table, columns)
+        return self._query(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE date >= ? AND date <= ? ORDER BY date DESC, id DESC",
+            (start_date.isoformat(), end_date.isoformat())
+        )
+    
+    def get_changes(self, table, since):
+        """Get rows of a synced table changed at or after the given high-water mark"""
+        mark_col, _ = self.SYNC_SPECS[table]
+        try:
+            return self._query(f"SELECT * FROM {table} WHERE {mark_col} >= ? ORDER BY {mark_col}", (since,))
+        except Exception as e:
+            st.error(f"Error syncing {table}: {e}")
+            return pd.DataFrame()
+    
+    # User operations
+    def get_users(self):
+        """Get all users"""
+        try:
+            return self._query("SELECT * FROM users ORDER BY username")
+        except Exception as e:
+            st.error(f"Error fetching users: {e}")
+            return pd.DataFrame()
+    
+    def get_user(self, username):
+        """Get user by username"""
+        try:
+            row = self.conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            st.error(f"Error fetching user: {e}")
+            return None
+    
+    def has_users(self):
+        """Whether any user exists; None if the backend could not be asked"""
+        try:
+            return self.conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0] == 1
+        except Exception as e:
+            st.error(f"Error checking users: {e}")
+            return None
+    
+    def create_user(self, user_data):
+        """Create new user"""
+        return self._insert('users', user_data)
+    
+    def upsert_users(self, users):
+        """Insert or update a batch of users keyed by username"""
+        return self._insert('users', users, upsert=True)
+    
+    def update_user(self, username, updates):
+        """Update user"""
+        return self._update('users', username, updates)
+    
+    def delete_user(self, username):
+        """Delete user"""
+        return self._delete('users', username)
+    
+    # Session operations
+    def revoke_session(self, token_id, expires_at):
+        """Record a signed-out session token so no server process resumes it before it expires"""
+        try:
+            # Tokens past their expiry are rejected anyway, so their rows can go
+            self.conn.execute("DELETE FROM revoked_sessions WHERE expires_at < ?", (int(time.time()),))
+            self.conn.execute("INSERT INTO revoked_sessions (token_id, expires_at) VALUES (?, ?) "
+                              "ON CONFLICT (token_id) DO NOTHING", (token_id, int(expires_at)))
+            return True, [{'token_id': token_id, 'expires_at': int(expires_at)}]
+        except Exception as e:
+            return False, str(e)
+    
+    def is_session_revoked(self, token_id):
+        """Whether a session token was signed out; None if the backend could not be asked"""
+        try:
+            return self.conn.execute("SELECT EXISTS (SELECT 1 FROM revoked_sessions WHERE token_id = ?)",
+                                     (token_id,)).fetchone()[0] == 1
+        except Exception as e:
+            st.error(f"Error checking session: {e}")
+            return None
+    
+    # Inventory operations
+    def get_inventory(self):
+        """Get all inventory items"""
+        try:
+            return self._query("SELECT * FROM inventory ORDER BY item_id")
+        except Exception as e:
+            st.error(f"Error fetching inventory: {e}")
+            return pd.DataFrame()
+    
+    def search_inventory(self, query, limit=50):
+        """Get up to ``limit`` inventory items whose name or ID contains ``query``"""
+        term = query.strip()
+        if not term:
+            return pd.DataFrame()
+        pattern = '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%'
+        try:
+            return self._query(
+                "SELECT * FROM inventory WHERE item_name LIKE ? ESCAPE '\\' OR item_id LIKE ? ESCAPE '\\' "
+                "ORDER BY item_name LIMIT ?",
+                (pattern, pattern, int(limit))
+            )
+        except Exception as e:
+            st.error(f"Error searching inventory: {e}")
+            return pd.DataFrame()
+    
+    def create_inventory_item(self, item_data):
+        """Create new inventory item"""
+        return self._insert('inventory', item_data)
+    
+    def upsert_inventory_items(self, items):
+        """Insert or update a batch of inventory items keyed by item_id"""
+        return self._insert('inventory', items, upsert=True)
+    
+    def update_inventory_item(self, item_id, updates):
+        """Update inventory item"""
+        return self._update('inventory', item_id, updates)
+    
+    def delete_inventory_item(self, item_id):
+        """Delete inventory item"""
+        return self._delete('inventory', item_id)
+    
+    def allocate_id_block(self, prefix, count):
+        """Reserve ``count`` consecutive numbers for item IDs starting with ``prefix``; returns (True, first number)"""
+        pattern = re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+        cur = self.conn.cursor()
+        # The write lock makes read-then-bump atomic across threads and processes
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            row = cur.execute("SELECT last_value FROM id_counters WHERE prefix = ?", (prefix,)).fetchone()
+            # Never hand out a number already used, e.g. by an ID given explicitly in an import
+            used = [int(item_id[len(prefix):]) for (item_id,) in cur.execute(
+                "SELECT item_id FROM inventory WHERE item_id LIKE ? ESCAPE '\\'", (pattern,))
+                if item_id[len(prefix):].isdigit()]
+            last = max([row[0] if row else 0] + used)
+            cur.execute("INSERT INTO id_counters (prefix, last_value) VALUES (?, ?) "
+                        "ON CONFLICT (prefix) DO UPDATE SET last_value = excluded.last_value",
+                        (prefix, last + int(count)))
+            cur.execute("COMMIT")
+        except Exception as e:
+            cur.execute("ROLLBACK")
+            return False, str(e)
+        return True, last + 1
+    
+    # Receipts operations
+    def get_receipts(self):
+        """Get all receipts"""
+        try:
+            return self._query("SELECT * FROM receipts ORDER BY date DESC, id DESC")
+        except Exception as e:
+            st.error(f"Error fetching receipts: {e}")
+            return pd.DataFrame()
+    
+    def get_receipts_between(self, start_date, end_date, columns=None):
+        """Get receipts dated within [start_date, end_date], newest first"""
+        try:
+            return self._history('receipts', start_date, end_date, columns)
+        except Exception as e:
+            st.error(f"Error fetching receipts: {e}")
+            return pd.DataFrame()
+    
+    def create_receipt(self, receipt_data):
+        """Create new receipt"""
+        return self._insert('receipts', receipt_data)
+    
+    # Issues operations
+    def get_issues(self):
+        """Get all issues"""
+        try:
+            return self._query("SELECT * FROM issues ORDER BY date DESC, id DESC")
+        except Exception as e:
+            st.error(f"Error fetching issues: {e}")
+            return pd.DataFrame()
+    
+    def get_issues_between(self, start_date, end_date, columns=None):
+        """Get issues dated within [start_date, end_date], newest first"""
+        try:
+            return self._history('issues', start_date, end_date, columns)
+        except Exception as e:
+            st.error(f"Error fetching issues: {e}")
+            return pd.DataFrame()
+    
+    def create_issue(self, issue_data):
+        """Create new issue"""
+        return self._insert('issues', issue_data)
+    
+    # Stock movement operations
+    def record_stock_movements(self, kind, entries, username):
+        """Apply a multi-line receipt or issue voucher in one transaction with a bulk ledger insert"""
+        if kind not in self.LEDGER_COLUMNS:
+            return False, f"Unknown movement kind: {kind}"
+        if not entries or any(int(entry.get('quantity') or 0) <= 0 for entry in entries):
+            return False, "Quantity must be greater than 0 on every line"
+        
+        table, columns = self.LEDGER_COLUMNS[kind]
+        sign = 1 if kind == 'receipt' else -1
+        now = datetime.now().isoformat()
+        refs = [entry['client_ref'] for entry in entries if entry.get('client_ref')]
+        item_ids = sorted({entry['item_id'] for entry in entries})
+        placeholders = ', '.join('?' * len(item_ids))
+        
+        cur = self.conn.cursor()
+        # BEGIN IMMEDIATE takes the write lock up front, so the balance checks below
+        # cannot race another writer
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Lines already recorded under their client_ref (a replayed offline voucher) are skipped
+            recorded = {row[0] for row in cur.execute(
+                f"SELECT client_ref FROM {table} WHERE client_ref IN ({', '.join('?' * len(refs))})", refs)}
+            entries = [entry for entry in entries if entry.get('client_ref') not in recorded]
+            deltas = {}
+            for entry in entries:
+                deltas[entry['item_id']] = deltas.get(entry['item_id'], 0) + int(entry['quantity'])
+            
+            balances = dict(cur.execute(
+                f"SELECT item_id, quantity FROM inventory WHERE item_id IN ({placeholders})", item_ids
+            ).fetchall())
+            missing = [item_id for item_id in deltas if item_id not in balances]
+            if missing:
+                raise ValueError(f"Items not found: {', '.join(missing)}")
+            if kind == 'issue':
+                short = [f"{item_id} (requested {deltas[item_id]}, available {balances[item_id]})"
+                         for item_id in sorted(deltas) if balances[item_id] < deltas[item_id]]
+                if short:
+                    raise ValueError(f"Insufficient stock: {', '.join(short)}")
+            
+            cur.executemany(
+                "UPDATE inventory SET quantity = quantity + ?, updated_at = ?, updated_by = ? WHERE item_id = ?",
+                [(sign * delta, now, username, item_id) for item_id, delta in sorted(deltas.items())]
+            )
+            last_id = cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            cur.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                # recorded_at keeps when the clerk entered the line, which for a replayed offline
+                # voucher can be long ago; created_at is the write time delta sync keys on
+                [[entry.get(col) for col in columns[:-2]] + [entry.get('created_at') or now, now]
+                 for entry in entries]
+            )
+            items = [dict(row) for row in cur.execute(
+                f"SELECT * FROM inventory WHERE item_id IN ({placeholders})", item_ids)]
+            ledger_rows = [dict(row) for row in cur.execute(
+                f"SELECT * FROM {table} WHERE id > ? OR client_ref IN ({', '.join('?' * len(refs))}) ORDER BY id",
+                [last_id] + refs)]
+            cur.execute("COMMIT")
+        except Exception as e:
+            cur.execute("ROLLBACK")
+            return False, str(e)
+        
+        return True, {'items': items, 'entries': ledger_rows}
+    
+    # Aggregate operations
+    def get_inventory_kpis(self, fallback=None):
+        """Get dashboard KPIs computed by SQLite"""
+        # Days to expiry are floored whole days, matching pandas' (expiry - now).dt.days
+        row = self.conn.execute("""
+            WITH diff AS (
+                SELECT quantity, reorder_level, category,
+                       julianday(expiry_date) - julianday('now', 'localtime') AS days
+                FROM inventory
+            ), expiry AS (
+                -- floor() without relying on SQLite's optional math functions
+                SELECT *, CAST(days AS INTEGER) - (days < CAST(days AS INTEGER)) AS days_to_expiry
+                FROM diff
+            )
+            SELECT COUNT(*) AS total_items,
+                   COALESCE(SUM(quantity), 0) AS total_units,
+                   SUM(quantity <= reorder_level AND quantity > 0) AS low_stock,
+                   SUM(days_to_expiry <= 0) AS expired,
+                   SUM(days_to_expiry > 0 AND days_to_expiry <= 30) AS expiring_30,
+                   COUNT(DISTINCT category) AS categories
+            FROM expiry
+        """).fetchone()
+        return {key: int(row[key] or 0) for key in row.keys()}
+    
+    def get_category_totals(self, fallback=None):
+        """Get units and item counts per category"""
+        return self._query("SELECT category, COALESCE(SUM(quantity), 0) AS quantity, COUNT(*) AS items "
+                           "FROM inventory GROUP BY category ORDER BY category")
+    
+    def get_low_stock_items(self, fallback=None):
+        """Get items at or below their reorder level"""
+        return self._query("SELECT item_name, category, quantity, unit, reorder_level FROM inventory "
+                           "WHERE quantity <= reorder_level ORDER BY quantity, item_name")
+    
+    def get_movement_totals(self, fallback=None):
+        """Get total units and row counts for receipts and issues"""
+        row = self.conn.execute("""
+            SELECT (SELECT COALESCE(SUM(quantity), 0) FROM receipts) AS total_received,
+                   (SELECT COALESCE(SUM(quantity), 0) FROM issues) AS total_issued,
+                   (SELECT COUNT(*) FROM receipts) AS receipt_count,
+                   (SELECT COUNT(*) FROM issues) AS issue_count
+        """).fetchone()
+        return {key: int(row[key] or 0) for key in row.keys()}
+
+@st.cache_resource
+def init_database():
+    """Create the configured storage backend (SMIS_BACKEND: supabase or sqlite)"""
+    if str(get_setting("SMIS_BACKEND", "supabase")).lower() == 'sqlite':
+        return SQLiteDatabaseManager(get_setting("SMIS_SQLITE_PATH", "smis.db"))
+    return DatabaseManager(init_supabase())
+
+# Initialize database manager
+db = init_database()
+
+# ========== ITEM ID ALLOCATION ==========
+class ItemIdAllocator:
+    """Hands out STR-<CAT>-<date>-NNNN item IDs from number blocks reserved in the database"""
+    def __init__(self, db_manager, block_size=10):
+        self.db = db_manager
+        self.block_size = int(block_size)
+        # prefix -> (next unused number, last reserved number)
+        self._blocks = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def prefix(category, day=None):
+        """ID prefix for a category; counters restart every day"""
+        return f"STR-{str(category)[:3].upper()}-{(day or datetime.now()).strftime('%Y%m%d')}-"
+    
+    def allocate(self, category, count=1):
+        """Reserve ``count`` new IDs for a category; returns (True, ids) or (False, error)"""
+        prefix = self.prefix(category)
+        with self._lock:
+            next_number, last = self._blocks.get(prefix, (1, 0))
+            numbers = list(range(next_number, min(last, next_number + count - 1) + 1))
+            next_number += len(numbers)
+            
+            needed = count - len(numbers)
+            if needed:
+                # Bulk requests reserve everything they still need in one round trip
+                reserved = max(needed, self.block_size)
+                success, first = self.db.allocate_id_block(prefix, reserved)
+                if not success:
+                    return False, first
+                numbers += range(first, first + needed)
+                next_number, last = first + needed, first + reserved - 1
+            
+            # Blocks of earlier days are never drawn from again
+            today = prefix[-9:]
+            self._blocks = {key: block for key, block in self._blocks.items() if key.endswith(today)}
+            self._blocks[prefix] = (next_number, last)
+        return True, [f"{prefix}{number:04d}" for number in numbers]
+
+# ========== OFFLINE WRITE QUEUE ==========
+class MovementOutbox:
+    """Durable local queue for stock movements recorded while the backend was unreachable"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_ref TEXT NOT NULL UNIQUE,
+            voucher TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            username TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            queued_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, id);
+    """
+    
+    def __init__(self, path, batch_size=200, interval=15):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._replay_lock = threading.Lock()
+        self._thread = None
+        with self._transaction() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+    
+    @contextmanager
+    def _transaction(self):
+        # Short-lived connections keep the queue usable from any session or thread
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+    
+    def enqueue(self, kind, entries, username, voucher):
+        """Persist the lines of one voucher; each must already carry its client_ref"""
+        now = datetime.now().isoformat()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO outbox (client_ref, voucher, kind, username, entry, queued_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(entry['client_ref'], voucher, kind, username, json.dumps(entry), now) for entry in entries]
+            )
+    
+    def counts(self):
+        """Number of queued lines by status (pending, failed)"""
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        return {'pending': counts.get('pending', 0), 'failed': counts.get('failed', 0)}
+    
+    def get_entries(self):
+        """Get all queued lines with their status"""
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT * FROM outbox ORDER BY id").fetchall()
+        if not rows:
+            return pd.DataFrame()
+        queued = pd.DataFrame([dict(row) for row in rows])
+        lines = pd.DataFrame([json.loads(entry) for entry in queued['entry']])
+        lines = lines.reindex(columns=['date', 'item_id', 'item_name', 'quantity'])
+        return pd.concat([queued.drop(columns='entry'), lines], axis=1)
+    
+    def retry_failed(self):
+        """Put rejected lines back in the queue, e.g. after stock was corrected"""
+        with self._transaction() as conn:
+            conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'failed'")
+    
+    def discard_failed(self):
+        """Drop rejected lines from the queue"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM outbox WHERE status = 'failed'")
+    
+    def replay(self, db_manager, on_recorded=None):
+        """Flush pending lines in queue order; returns a summary, or None if a replay is already running"""
+        if not self._replay_lock.acquire(blocking=False):
+            return None
+        try:
+            return self._replay(db_manager, on_recorded)
+        finally:
+            self._replay_lock.release()
+    
+    def start(self, db_manager, on_recorded=None):
+        """Replay the queue every ``interval`` seconds on a background thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(db_manager, on_recorded),
+                                            daemon=True, name="smis-outbox")
+            self._thread.start()
+    
+    def _run(self, db_manager, on_recorded):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.counts()['pending']:
+                    self.replay(db_manager, on_recorded)
+            except Exception:
+                # The replayer must outlive any single bad pass
+                pass
+    
+    def _replay(self, db_manager, on_recorded):
+        with self._transaction() as conn:
+            rows = [dict(row) for row in conn.execute("SELECT * FROM outbox WHERE status = 'pending' ORDER BY id")]
+        summary = {'recorded': 0, 'rejected': 0, 'remaining': len(rows)}
+        
+        for batch in self._batches(rows):
+            kind, username = batch[0]['kind'], batch[0]['username']
+            success, result = db_manager.record_stock_movements(
+                kind, [json.loads(row['entry']) for row in batch], username)
+            if isinstance(result, BackendUnavailable):
+                self._mark(batch, 'pending', str(result))
+                break
+            if success:
+                self._recorded(batch, kind, result, on_recorded, summary)
+                continue
+            
+            # One bad voucher rejects the whole batch; retry voucher by voucher so
+            # only the offending one is held back, and vouchers stay all-or-nothing
+            for voucher in self._vouchers(batch):
+                success, result = db_manager.record_stock_movements(
+                    kind, [json.loads(row['entry']) for row in voucher], username)
+                if isinstance(result, BackendUnavailable):
+                    self._mark(voucher, 'pending', str(result))
+                    return summary
+                if success:
+                    self._recorded(voucher, kind, result, on_recorded, summary)
+                else:
+                    self._mark(voucher, 'failed', str(result))
+                    summary['rejected'] += len(voucher)
+                    summary['remaining'] -= len(voucher)
+        return summary
+    
+    def _batches(self, rows):
+        # Consecutive lines of the same kind and user share a call; order is kept so a
+        # receipt queued before an issue of the same item is applied first
+        batch = []
+        for row in rows:
+            if batch and ((row['kind'], row['username']) != (batch[0]['kind'], batch[0]['username'])
+                          or len(batch) >= self.batch_size and row['voucher'] != batch[-1]['voucher']):
+                yield batch
+                batch = []
+            batch.append(row)
+        if batch:
+            yield batch
+    
+    @staticmethod
+    def _vouchers(batch):
+        vouchers = {}
+        for row in batch:
+            vouchers.setdefault(row['voucher'], []).append(row)
+        return list(vouchers.values())
+    
+    def _recorded(self, rows, kind, result, on_recorded, summary):
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(row['id'],) for row in rows])
+        summary['recorded'] += len(rows)
+        summary['remaining'] -= len(rows)
+        if on_recorded:
+            on_recorded(kind, result)
+    
+    def _mark(self, rows, status, error):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ? WHERE id = ?",
+                [(status, error, row['id']) for row in rows]
+            )
+
+# ========== BULK IMPORT ==========
+def normalise_choice(values, choices, aliases=None):
+    """Map free-text values onto a canonical list, tolerating case, plurals and known aliases"""
+    lookup = {}
+    for choice in choices:
+        lookup[choice.lower().rstrip('s')] = choice
+        lookup[choice.lower() + 's'] = choice
+    lookup.update({choice.lower(): choice for choice in choices})
+    lookup.update(aliases or {})
+    return values.astype('string').str.strip().str.lower().map(lookup)
+
+class BulkImporter:
+    """Chunked, resumable import of a workbook or CSV into one table"""
+    table = None
+    key = None
+    # Normalised spreadsheet header -> column name, for headers that differ
+    COLUMN_MAP = {}
+    
+    def __init__(self, db_manager, chunk_size=500, checkpoint_dir=None):
+        self.db = db_manager
+        self.chunk_size = int(chunk_size)
+        self.checkpoint_dir = checkpoint_dir or get_setting("SMIS_IMPORT_CHECKPOINT_DIR", ".import_checkpoints")
+    
+    def prepare(self, batch, rows):
+        """Validate and normalise one batch; returns (clean rows, issues)"""
+        raise NotImplementedError
+    
+    def finalise(self, plan, existing):
+        """Deduplicate, assign keys and fill defaults on the full plan; returns (plan, issues)"""
+        raise NotImplementedError
+    
+    def iter_batches(self, source, name):
+        """Stream a workbook (read-only mode) or CSV as frames of at most ``chunk_size`` rows"""
+        if name.lower().endswith(('.xlsx', '.xlsm')):
+            workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+            try:
+                rows = workbook.worksheets[0].iter_rows(values_only=True)
+                header = [self._column_name(value) for value in next(rows, ())]
+                batch = []
+                for row in rows:
+                    if any(value is not None for value in row):
+                        batch.append(row)
+                    if len(batch) >= self.chunk_size:
+                        yield pd.DataFrame(batch, columns=header)
+                        batch = []
+                if batch:
+                    yield pd.DataFrame(batch, columns=header)
+            finally:
+                workbook.close()
+        else:
+            for chunk in pd.read_csv(source, chunksize=self.chunk_size, dtype=str):
+                chunk.columns = [self._column_name(col) for col in chunk.columns]
+                yield chunk
+    
+    def plan(self, source, name, existing):
+        """Read and validate the whole file in batches; returns (plan, issues, rows read)"""
+        clean, issues = [], []
+        first_row = 2  # spreadsheet row of the first data line, after the header
+        for batch in self.iter_batches(source, name):
+            batch = batch.reset_index(drop=True)
+            rows = pd.Series(batch.index + first_row, index=batch.index)
+            batch_clean, batch_issues = self.prepare(batch, rows)
+            clean.append(batch_clean)
+            issues.append(batch_issues)
+            first_row += len(batch)
+        
+        plan = pd.concat(clean, ignore_index=True) if clean else pd.DataFrame()
+        plan, final_issues = self.finalise(plan, existing) if not plan.empty else (plan, self._issues())
+        issues = pd.concat(issues + [final_issues], ignore_index=True) if issues else final_issues
+        issues['row'] = issues['row'].astype(int)
+        return plan, issues.sort_values('row', kind='stable').reset_index(drop=True), first_row - 2
+    
+    def has_checkpoint(self, data):
+        """Whether an earlier import of exactly this file stopped part-way"""
+        return os.path.exists(self._checkpoint_paths(data)[0])
+    
+    def run(self, data, name, existing, dry_run=False, progress=None):
+        """Validate the file, then upsert it chunk by chunk, resuming an earlier failed run"""
+        plan_path, state_path = self._checkpoint_paths(data)
+        resumed = not dry_run and os.path.exists(plan_path)
+        if resumed:
+            plan = pd.read_parquet(plan_path)
+            with open(state_path) as f:
+                state = json.load(f)
+            # Older checkpoints counted chunks of an unknown size; upserts are idempotent, so start over
+            state.setdefault('rows_done', 0)
+            issues = pd.DataFrame(state['issues'], columns=['row', 'level', 'message'])
+        else:
+            plan, issues, rows_read = self.plan(io.BytesIO(data), name, existing)
+            state = {'rows_done': 0, 'rows_read': rows_read, 'issues': issues.to_dict('records')}
+        
+        # Progress is kept in plan rows, so a resumed run may use a different chunk size
+        rows_done = state['rows_done']
+        chunks = [plan.iloc[start:start + self.chunk_size] for start in range(rows_done, len(plan), self.chunk_size)]
+        report = {
+            'rows_read': state['rows_read'],
+            'to_insert': int((plan.get('_action') == 'insert').sum()) if not plan.empty else 0,
+            'to_update': int((plan.get('_action') == 'update').sum()) if not plan.empty else 0,
+            'rejected': int(issues.loc[issues['level'] == 'error', 'row'].nunique()),
+            'chunks': len(chunks),
+            'resumed_from': rows_done if resumed else None,
+            'imported': 0,
+            'written': [],
+            'error': None,
+            'issues': issues,
+        }
+        if dry_run or not chunks:
+            return report
+        
+        # Keys are reserved only for a real run, and saved with the plan so a resumed run reuses them
+        if not resumed:
+            plan, error = self.assign_keys(plan)
+            if error:
+                report['error'] = error
+                return report
+            chunks = [plan.iloc[start:start + self.chunk_size] for start in range(0, len(plan), self.chunk_size)]
+        
+        # Persist the plan first so a resumed run reuses the same keys
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        if not resumed:
+            plan.to_parquet(plan_path, index=False)
+            self._save_state(state_path, state)
+        
+        for number, chunk in enumerate(chunks):
+            chunk = chunk.drop(columns=['_action'])
+            records = chunk.astype(object).where(chunk.notna(), None).to_dict('records')
+            success, result = self.upsert(records)
+            if not success:
+                report['error'] = f"Chunk {number + 1} of {len(chunks)} failed: {result}"
+                self._save_state(state_path, state)
+                return report
+            state['rows_done'] += len(records)
+            self._save_state(state_path, state)
+            report['imported'] += len(records)
+            if isinstance(result, list):
+                report['written'].extend(result)
+            if progress:
+                progress(state['rows_done'] / len(plan))
+        
+        os.remove(plan_path)
+        os.remove(state_path)
+        return report
+    
+    def assign_keys(self, plan):
+        """Give new rows their keys just before the first write; returns (plan, error)"""
+        return plan, None
+    
+    def upsert(self, records):
+        raise NotImplementedError
+    
+    def _column_name(self, header):
+        name = re.sub(r'\s+', '_', str(header).strip().lower())
+        return self.COLUMN_MAP.get(name, name)
+    
+    def _checkpoint_paths(self, data):
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        base = os.path.join(self.checkpoint_dir, f"{self.table}-{digest}")
+        return base + '.parquet', base + '.json'
+    
+    def _save_state(self, path, state):
+        # Write then rename so a crash never leaves a half-written checkpoint
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, default=str)
+        os.replace(path + '.tmp', path)
+    
+    @staticmethod
+    def _issues(rows=(), level='error', messages=()):
+        return pd.DataFrame({'row': list(rows), 'level': level, 'message': list(messages)},
+                            columns=['row', 'level', 'message'])
+
+class InventoryImporter(BulkImporter):
+    """Import items from Stores Data.xlsx or a CSV with the same headers"""
+    table = 'inventory'
+    key = 'item_id'
+    COLUMN_MAP = {'name': 'item_name', 'item': 'item_name', 'qty': 'quantity', 'expiry': 'expiry_date',
+                  'location': 'storage_location', 'reorder': 'reorder_level', 'id': 'item_id'}
+    CATEGORY_ALIASES = {'micellaneous': 'Miscellaneous', 'misc': 'Miscellaneous',
+                        'computer accessories': 'Comp/Printer/Accessories',
+                        'lab items': 'Laboratory Items', 'vehicle parts': 'Vehicle Parts - Toyota Hilux'}
+    UNIT_ALIASES = {'pack': 'Packets', 'packs': 'Packets', 'pcs': 'Pieces', 'pc': 'Pieces', 'box': 'Boxes',
+                    'liter': 'Litre', 'liters': 'Litre', 'ltr': 'Litre', 'ctn': 'Cartons'}
+    OPTIONAL_COLUMNS = {'storage_location': 'Main Store', 'reorder_level': 10,
+                        'supplier': 'Standard Supplier', 'notes': ''}
+    
+    def __init__(self, db_manager, chunk_size=500, checkpoint_dir=None, username='import', id_allocator=None):
+        super().__init__(db_manager, chunk_size, checkpoint_dir)
+        self.username = username
+        self.id_allocator = id_allocator or ItemIdAllocator(db_manager)
+    
+    def upsert(self, records):
+        return self.db.upsert_inventory_items(records)
+    
+    def prepare(self, batch, rows):
+        if 'item_name' not in batch.columns:
+            return pd.DataFrame(), self._issues(rows, 'error', ["Missing 'Item Name' column"] * len(rows))
+        
+        issues = []
+        clean = pd.DataFrame(index=batch.index)
+        clean['item_name'] = batch['item_name'].astype('string').str.strip()
+        if 'item_id' in batch.columns:
+            clean['item_id'] = batch['item_id'].astype('string').str.strip()
+        
+        raw_category = batch.get('category', pd.Series(pd.NA, index=batch.index))
+        clean['category'] = normalise_choice(raw_category, ITEM_CATEGORIES, self.CATEGORY_ALIASES)
+        unknown = clean['category'].isna()
+        issues.append(self._issues(rows[unknown], 'warning',
+                                   "Unknown category '" + raw_category[unknown].astype('string').fillna('') +
+                                   "' filed under Miscellaneous"))
+        clean['category'] = clean['category'].fillna('Miscellaneous')
+        
+        raw_unit = batch.get('unit', pd.Series(pd.NA, index=batch.index))
+        clean['unit'] = normalise_choice(raw_unit, ITEM_UNITS, self.UNIT_ALIASES)
+        unknown = clean['unit'].isna()
+        issues.append(self._issues(rows[unknown], 'warning',
+                                   "Unknown unit '" + raw_unit[unknown].astype('string').fillna('') +
+                                   "' recorded as Units"))
+        clean['unit'] = clean['unit'].fillna('Units')
+        
+        quantity = pd.to_numeric(batch.get('quantity'), errors='coerce')
+        fractional = quantity.notna() & (quantity % 1 != 0)
+        issues.append(self._issues(rows[fractional], 'warning',
+                                   "Fractional quantity " + quantity[fractional].astype(str) + " rounded"))
+        clean['quantity'] = quantity.round()
+        
+        if 'expiry_date' in batch.columns:
+            expiry = pd.to_datetime(batch['expiry_date'], errors='coerce')
+            bad = batch['expiry_date'].notna() & expiry.isna()
+            issues.append(self._issues(rows[bad], 'warning',
+                                       "Unreadable expiry date '" + batch['expiry_date'][bad].astype(str) +
+                                       "' ignored"))
+            clean['expiry_date'] = expiry.dt.strftime('%Y-%m-%d').where(expiry.notna(), None)
+        
+        for col in self.OPTIONAL_COLUMNS:
+            if col in batch.columns:
+                clean[col] = batch[col]
+        if 'reorder_level' in clean.columns:
+            clean['reorder_level'] = pd.to_numeric(clean['reorder_level'], errors='coerce')
+        
+        missing_name = clean['item_name'].isna() | (clean['item_name'] == '')
+        bad_quantity = ~missing_name & (clean['quantity'].isna() | (clean['quantity'] < 0))
+        issues.append(self._issues(rows[missing_name], 'error', ['Item name is missing'] * int(missing_name.sum())))
+        issues.append(self._issues(rows[bad_quantity], 'error',
+                                   "Invalid quantity '" + batch.get('quantity')[bad_quantity].astype(str) + "'"))
+        
+        clean['_row'] = rows
+        return clean[~(missing_name | bad_quantity)], pd.concat(issues, ignore_index=True)
+    
+    def finalise(self, plan, existing):
+        issues = []
+        # Later rows win when the same item appears twice in the file
+        name_key = plan['item_name'].str.lower()
+        duplicated = name_key.duplicated(keep='last')
+        issues.append(self._issues(plan['_row'][duplicated], 'warning',
+                                   "Duplicate of a later row for '" + plan['item_name'][duplicated] +
+                                   "'; skipped"))
+        plan = plan[~duplicated].reset_index(drop=True)
+        
+        # Match existing items by ID, then by name, so re-imports update rather than duplicate
+        if not existing.empty and 'item_id' in existing.columns:
+            by_name = existing.assign(_name=existing['item_name'].str.lower()).drop_duplicates('_name')
+            by_name = by_name.set_index('_name')['item_id']
+            matched = plan['item_name'].str.lower().map(by_name)
+            plan['item_id'] = plan['item_id'].fillna(matched) if 'item_id' in plan.columns else matched
+            is_existing = plan['item_id'].isin(existing['item_id'])
+        else:
+            if 'item_id' not in plan.columns:
+                plan['item_id'] = pd.NA
+            is_existing = pd.Series(False, index=plan.index)
+        plan['_action'] = np.where(is_existing, 'update', 'insert')
+        
+        # Blank or absent columns keep the existing item's value, else take the default
+        now = datetime.now().isoformat()
+        current = (existing.drop_duplicates('item_id').set_index('item_id')
+                   if 'item_id' in existing.columns else pd.DataFrame())
+        defaults = {**self.OPTIONAL_COLUMNS, 'created_date': now, 'created_by': self.username}
+        for col, default in defaults.items():
+            values = plan[col] if col in plan.columns else pd.Series(pd.NA, index=plan.index, dtype=object)
+            if col in current.columns:
+                values = values.where(values.notna(), plan['item_id'].map(current[col]))
+            plan[col] = values.where(values.notna(), default)
+        plan['updated_at'] = now
+        plan['updated_by'] = self.username
+        plan['quantity'] = plan['quantity'].astype(int)
+        plan['reorder_level'] = pd.to_numeric(plan['reorder_level'], errors='coerce').fillna(10).astype(int)
+        
+        # New items get their IDs from assign_keys, once the import actually runs
+        return plan.drop(columns=['_row']), pd.concat(issues, ignore_index=True)
     
-    # Inventory operations
-    def get_inventory(self):
-        """Get all inventory items"""
-        try:
-            response = self.supabase.table('inventory').select('*').execute()
-            if response.data:
-                return pd.DataFrame(response.data)
-            return pd.DataFrame()
-        except Exception as e:
-            st.error(f"Error fetching inventory: {e}")
-            return pd.DataFrame()
+    def assign_keys(self, plan):
+        new_items = plan['item_id'].isna()
+        if not new_items.any():
+            return plan, None
+        plan = plan.copy()
+        # One block reservation per category, however many rows it has
+        for category, index in plan[new_items].groupby('category').groups.items():
+            success, item_ids = self.id_allocator.allocate(category, len(index))
+            if not success:
+                return plan, f"Could not allocate item IDs: {item_ids}"
+            plan.loc[index, 'item_id'] = item_ids
+        return plan, None
+
+class UserImporter(BulkImporter):
+    """Import users from store_users.csv; passwords may be SHA-256 hashes or plain text"""
+    table = 'users'
+    key = 'username'
+    ROLES = ['user', 'manager', 'admin']
     
-    def create_inventory_item(self, item_data):
-        """Create new inventory item"""
-        try:
-            response = self.supabase.table('inventory').insert(item_data).execute()
-            return True, response.data
-        except Exception as e:
-            return False, str(e)
+    def __init__(self, db_manager, chunk_size=500, checkpoint_dir=None, username='import'):
+        super().__init__(db_manager, chunk_size, checkpoint_dir)
+        self.username = username
     
-    def update_inventory_item(self, item_id, updates):
-        """Update inventory item"""
-        try:
-            response = self.supabase.table('inventory').update(updates).eq('item_id', item_id).execute()
-            return True, response.data
-        except Exception as e:
-            return False, str(e)
+    def upsert(self, records):
+        return self.db.upsert_users(records)
     
-    def delete_inventory_item(self, item_id):
-        """Delete inventory item"""
-        try:
-            response = self.supabase.table('inventory').delete().eq('item_id', item_id).execute()
-            return True, response.data
-        except Exception as e:
-            return False, str(e)
+    def prepare(self, batch, rows):
+        issues = []
+        clean = pd.DataFrame(index=batch.index)
+        for col in ['username', 'password', 'full_name', 'role', 'department', 'created_at', 'created_by']:
+            clean[col] = batch[col].astype('string').str.strip() if col in batch.columns else pd.NA
+        
+        clean['role'] = clean['role'].str.lower()
+        missing = clean['username'].isna() | clean['password'].isna() | clean['full_name'].isna()
+        bad_role = ~missing & ~clean['role'].isin(self.ROLES)
+        issues.append(self._issues(rows[missing], 'error',
+                                   ['Username, password and full name are required'] * int(missing.sum())))
+        issues.append(self._issues(rows[bad_role], 'error',
+                                   "Unknown role '" + clean['role'][bad_role].fillna('') + "'"))
+        
+        plain = ~missing & ~clean['password'].str.fullmatch(r'[0-9a-f]{64}').fillna(False)
+        issues.append(self._issues(rows[plain], 'warning', ['Plain-text password hashed on import'] * int(plain.sum())))
+        clean.loc[plain, 'password'] = clean.loc[plain, 'password'].map(
+            lambda value: hashlib.sha256(value.encode()).hexdigest())
+        
+        clean['_row'] = rows
+        return clean[~(missing | bad_role)], pd.concat(issues, ignore_index=True)
     
-    # Receipts operations
-    def get_receipts(self):
-        """Get all receipts"""
-        try:
-            response = self.supabase.table('receipts').select('*').order('date', desc=True).execute()
-            if response.data:
-                return pd.DataFrame(response.data)
-            return pd.DataFrame()
-        except Exception as e:
-            st.error(f"Error fetching receipts: {e}")
-            return pd.DataFrame()
+    def finalise(self, plan, existing):
+        duplicated = plan['username'].duplicated(keep='last')
+        issues = self._issues(plan['_row'][duplicated], 'warning',
+                              "Duplicate of a later row for '" + plan['username'][duplicated] + "'; skipped")
+        plan = plan[~duplicated].reset_index(drop=True)
+        
+        usernames = existing['username'] if 'username' in existing.columns else pd.Series(dtype=str)
+        plan['_action'] = np.where(plan['username'].isin(usernames), 'update', 'insert')
+        plan['department'] = plan['department'].fillna('General Stores')
+        plan['created_at'] = plan['created_at'].fillna(datetime.now().isoformat())
+        plan['created_by'] = plan['created_by'].fillna(self.username)
+        return plan.drop(columns=['_row']), issues
+
+# ========== AUTHENTICATION SYSTEM ==========
+class UserDirectory:
+    """Process-wide copy of the users table, reloaded after ``ttl`` seconds"""
+    def __init__(self, db_manager, ttl=300):
+        self.db = db_manager
+        self.ttl = ttl
+        self._users = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
     
-    def create_receipt(self, receipt_data):
-        """Create new receipt"""
-        try:
-            response = self.supabase.table('receipts').insert(receipt_data).execute()
-            return True, response.data
-        except Exception as e:
-            return False, str(e)
+    def get_users(self):
+        """Get all users from the cache"""
+        with self._lock:
+            if self._users is None or time.monotonic() - self._loaded_at > self.ttl:
+                users = self.db.get_users()
+                # An empty result may be a failed fetch; keep what we had and ask again next time
+                if not users.empty or self._users is None:
+                    self._users = users
+                    self._loaded_at = time.monotonic() if not users.empty else 0.0
+            return self._users.copy()
     
-    # Issues operations
-    def get_issues(self):
-        """Get all issues"""
-        try:
-            response = self.supabase.table('issues').select('*').order('date', desc=True).execute()
-            if response.data:
-                return pd.DataFrame(response.data)
-            return pd.DataFrame()
-        except Exception as e:
-            st.error(f"Error fetching issues: {e}")
-            return pd.DataFrame()
+    def get_user(self, username, refresh=False):
+        """Get one user from the cache, asking the database on a miss or when ``refresh`` is set"""
+        if not refresh:
+            users = self.get_users()
+            if not users.empty:
+                match = users[users['username'] == username]
+                if not match.empty:
+                    return match.iloc[0].to_dict()
+        user = self.db.get_user(username)
+        if user:
+            self._put(user)
+        return user
     
-    def create_issue(self, issue_data):
-        """Create new issue"""
-        try:
-            response = self.supabase.table('issues').insert(issue_data).execute()
-            return True, response.data
-        except Exception as e:
-            return False, str(e)
+    def invalidate(self):
+        """Reload on the next read, e.g. after users were created or imported"""
+        with self._lock:
+            self._loaded_at = 0.0
+    
+    def _put(self, user):
+        with self._lock:
+            if self._users is None or self._users.empty:
+                return
+            users = self._users[self._users['username'] != user['username']]
+            self._users = pd.concat([users, pd.DataFrame([user])], ignore_index=True)
 
-# Initialize database manager
-db = DatabaseManager(supabase)
 
-# ========== AUTHENTICATION SYSTEM ==========
 class SupabaseAuth:
+    # The only user fields kept in a session; the password hash never leaves this class
+    PRINCIPAL_FIELDS = ('username', 'full_name', 'role', 'department')
+    # Cookie carrying the session token, so a reconnecting browser resumes; unlike a
+    # query parameter it stays out of shared links, browser history and proxy logs
+    TOKEN_COOKIE = 'smis_session'
+    # Query parameter earlier versions carried the token in; removed from the URL on sight
+    LEGACY_TOKEN_PARAM = 'session'
+    # Signed-in sessions remembered in-process
+    PRINCIPAL_CACHE_SIZE = 1000
+    
     def __init__(self, db_manager):
         self.db = db_manager
+        self.users = UserDirectory(db_manager, ttl=float(get_setting("SMIS_USER_CACHE_TTL", 300)))
         self.session_key = 'logged_in'
         self.username_key = 'username'
+        self.bootstrapped = False
+        # Without a configured secret, tokens stop resuming when the server restarts
+        self.session_secret = str(get_setting("SMIS_SESSION_SECRET") or secrets.token_hex(32)).encode()
+        self.session_ttl = float(get_setting("SMIS_SESSION_HOURS", 12)) * 3600
+        self._principals = OrderedDict()
+        self._sessions_lock = threading.Lock()
         
         # Initialize default admin user if not exists
         self.init_default_admin()
@@ -178,8 +2044,12 @@ class SupabaseAuth:
     
     def init_default_admin(self):
         """Initialize default admin user if no users exist"""
-        users_df = self.db.get_users()
-        if users_df.empty:
+        has_users = self.db.has_users()
+        if has_users is None:
+            # Backend unreachable; check_auth tries again on the next rerun
+            return
+        self.bootstrapped = True
+        if not has_users:
             admin_data = {
                 'username': 'admin',
                 'password': self.hash_password('NHRC@26'),
@@ -190,22 +2060,126 @@ class SupabaseAuth:
                 'created_by': 'system'
             }
             self.db.create_user(admin_data)
+            self.users.invalidate()
     
     def authenticate(self, username, password):
         """Authenticate user"""
-        user = self.db.get_user(username)
-        if user and user['password'] == self.hash_password(password):
+        password_hash = self.hash_password(password)
+        user = self.users.get_user(username)
+        if user and user['password'] != password_hash:
+            # The password may have changed since the directory was loaded
+            user = self.users.get_user(username, refresh=True)
+        if user and user['password'] == password_hash:
             return user
         return None
     
+    def principal(self, user):
+        """The minimal view of a user row that is kept in the session"""
+        return {field: user.get(field) if pd.notna(user.get(field)) else '' for field in self.PRINCIPAL_FIELDS}
+    
+    def issue_token(self, username):
+        """Sign a session token for a user"""
+        claims = {'u': username, 'exp': int(time.time() + self.session_ttl), 'n': secrets.token_hex(8)}
+        payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+        return f"{payload}.{self._sign(payload)}"
+    
+    def _sign(self, payload):
+        return hmac.new(self.session_secret, payload.encode(), hashlib.sha256).hexdigest()
+    
+    def _verify(self, token):
+        # Claims of a correctly signed, unexpired token; otherwise None
+        try:
+            payload, signature = token.split('.')
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        except Exception:
+            return None
+        if claims['exp'] < time.time():
+            return None
+        return claims
+    
+    def start_session(self, user):
+        """Sign the user in on this browser session and issue its resume token"""
+        principal = self.principal(user)
+        token = self.issue_token(principal['username'])
+        self._cache_principal(token, principal)
+        self._set_session(principal, token)
+        # Written by the next run, since the login form reruns straight away
+        st.session_state['session_cookie'] = token
+    
+    def _set_session(self, principal, token):
+        st.session_state[self.session_key] = True
+        st.session_state[self.username_key] = principal['username']
+        st.session_state['user_data'] = principal
+        st.session_state['session_token'] = token
+    
+    def resume_session(self, token):
+        """Principal for a valid session token, without checking the password again"""
+        claims = self._verify(token) if token else None
+        if claims is None:
+            return None
+        # Sign-outs are shared through the database; when it cannot be asked, refuse
+        if self.db.is_session_revoked(claims['n']) is not False:
+            return None
+        with self._sessions_lock:
+            cached = self._principals.get(token)
+        # Cached principals are trusted as long as the user directory itself would be
+        if cached and time.monotonic() - cached[1] < self.users.ttl:
+            return cached[0]
+        user = self.users.get_user(claims['u'])
+        if not user:
+            return None
+        principal = self.principal(user)
+        self._cache_principal(token, principal)
+        return principal
+    
+    def _cache_principal(self, token, principal):
+        with self._sessions_lock:
+            self._principals[token] = (principal, time.monotonic())
+            self._principals.move_to_end(token)
+            while len(self._principals) > self.PRINCIPAL_CACHE_SIZE:
+                self._principals.popitem(last=False)
+    
+    def _write_token_cookie(self, token):
+        """Set the session cookie in the browser, or clear it for an empty token"""
+        # Scripts cannot send Set-Cookie headers, so the cookie is written client-side
+        max_age = int(self.session_ttl) if token else 0
+        components.html(
+            f"""
+            <script>
+                const secure = window.parent.location.protocol === 'https:' ? '; Secure' : '';
+                window.parent.document.cookie =
+                    '{self.TOKEN_COOKIE}={token}; Path=/; Max-Age={max_age}; SameSite=Strict' + secure;
+            </script>
+            """,
+            height=0
+        )
+    
     def check_auth(self):
         """Check if user is authenticated"""
+        if not self.bootstrapped:
+            self.init_default_admin()
+        
         if self.session_key not in st.session_state:
             st.session_state[self.session_key] = False
             st.session_state[self.username_key] = ''
             st.session_state['user_data'] = {}
         
+        if self.LEGACY_TOKEN_PARAM in st.query_params:
+            del st.query_params[self.LEGACY_TOKEN_PARAM]
+        
+        pending_cookie = st.session_state.pop('session_cookie', None)
+        if pending_cookie is not None:
+            self._write_token_cookie(pending_cookie)
+        
         if not st.session_state[self.session_key]:
+            # Right after a sign-out the browser still sends the old cookie
+            token = st.context.cookies.get(self.TOKEN_COOKIE) if pending_cookie != '' else None
+            principal = self.resume_session(token)
+            if principal:
+                self._set_session(principal, token)
+                return principal
             self.show_login_interface()
             st.stop()
         else:
@@ -241,9 +2215,7 @@ class SupabaseAuth:
                             user_info = self.authenticate(username, password)
                             
                             if user_info:
-                                st.session_state[self.session_key] = True
-                                st.session_state[self.username_key] = username
-                                st.session_state['user_data'] = user_info
+                                self.start_session(user_info)
                                 
                                 st.success(f"✅ Signed in as {user_info['full_name']}")
                                 st.rerun()
@@ -252,9 +2224,17 @@ class SupabaseAuth:
     
     def logout(self):
         """Logout user"""
+        token = st.session_state.get('session_token')
+        claims = self._verify(token) if token else None
+        if claims:
+            # Kept until the token expires, so a copied cookie resumes on no server process
+            self.db.revoke_session(claims['n'], claims['exp'])
+            with self._sessions_lock:
+                self._principals.pop(token, None)
         for key in list(st.session_state.keys()):
             if key not in ['_theme', '_pages']:
                 del st.session_state[key]
+        st.session_state['session_cookie'] = ''
         st.rerun()
     
     def is_admin(self):
@@ -263,8 +2243,8 @@ class SupabaseAuth:
     
     def add_user(self, user_data, created_by):
         """Add new user"""
-        # Check if username exists
-        existing = self.db.get_user(user_data['username'])
+        # Check if username exists (a cache miss is checked against the database)
+        existing = self.users.get_user(user_data['username'])
         if existing:
             return False, "Username already exists"
         
@@ -276,12 +2256,18 @@ class SupabaseAuth:
         # Create user
         success, result = self.db.create_user(user_data)
         if success:
+            self.users.invalidate()
             return True, "User added successfully"
         else:
             return False, f"Error creating user: {result}"
 
 # Initialize authentication
-auth = SupabaseAuth(db)
+@st.cache_resource
+def get_auth():
+    """Process-wide auth service, so the default-admin check runs once rather than every rerun"""
+    return SupabaseAuth(db)
+
+auth = get_auth()
 
 # ========== PAGE CONFIGURATION ==========
 st.set_page_config(
@@ -421,41 +2407,851 @@ st.markdown("""
         box-sizing: border-box !important;
     }
     
-    .stTextInput>div>div>input:focus, 
-    .stNumberInput>div>div>input:focus, 
-    .stTextArea>div>textarea:focus, 
-    .stSelectbox>div>div>div:focus,
-    .stDateInput>div>div>input:focus {
-        border-color: var(--primary) !important;
-        box-shadow: 0 0 0 3px rgba(46, 125, 50, 0.1) !important;
-        outline: none !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+    .stTextInput>div>div>input:focus, 
+    .stNumberInput>div>div>input:focus, 
+    .stTextArea>div>textarea:focus, 
+    .stSelectbox>div>div>div:focus,
+    .stDateInput>div>div>input:focus {
+        border-color: var(--primary) !important;
+        box-shadow: 0 0 0 3px rgba(46, 125, 50, 0.1) !important;
+        outline: none !important;
+    }
+</style>
+""", unsafe_allow_html=True)
+
+# ========== CHECK AUTHENTICATION ==========
+user = auth.check_auth()
+
+# ========== LOAD DATA FROM SUPABASE ==========
+class TableSync:
+    """Process-wide table cache kept current with delta pulls and per-table data versions"""
+    # Re-read rows this far behind the high-water mark to absorb clerk clock skew
+    OVERLAP = timedelta(minutes=5)
+    
+    def __init__(self, db_manager, ttl=60, full_reload_every=900, snapshot_dir=None, enrichers=None):
+        self.db = db_manager
+        self.ttl = ttl
+        self.full_reload_every = full_reload_every
+        self.snapshot_dir = snapshot_dir
+        # Per-table functions adding derived columns; rerun whenever a table's rows change
+        self.enrichers = enrichers or {}
+        self._loaders = {
+            'inventory': db_manager.get_inventory,
+            'receipts': db_manager.get_receipts,
+            'issues': db_manager.get_issues,
+        }
+        self._entries = {}
+        self._versions = {table: 0 for table in self._loaders}
+        self._locks = {table: threading.Lock() for table in self._loaders}
+    
+    def version(self, table):
+        """Current data version of a table; bumps whenever its cached rows change"""
+        return self._versions[table]
+    
+    def get(self, table):
+        """Get a table, pulling only rows changed since the last sync"""
+        return self.snapshot(table)[0]
+    
+    def snapshot(self, table):
+        """Get a table and the data version of exactly those rows, read together under the table lock"""
+        with self._locks[table]:
+            entry = self._entries.get(table)
+            now = time.monotonic()
+            if entry is None:
+                # Cold start: serve the on-disk snapshot at once and revalidate behind it
+                entry = self._load_snapshot(table)
+                if entry is None:
+                    entry = self._full_load(table)
+            if entry['source'] == 'snapshot' and not entry['reload']:
+                self._revalidate_in_background(table, entry)
+            elif entry['reload'] or now - entry['loaded_at'] > self.full_reload_every:
+                entry = self._full_load(table)
+            elif entry['stale'] or now - entry['synced_at'] > self.ttl:
+                self._pull_changes(table, entry)
+            if entry['enriched_on'] != datetime.now().date():
+                # Date-relative columns such as days to expiry roll over at midnight
+                self._set_frame(table, entry, entry['frame'])
+                self._versions[table] += 1
+            # A copy-on-write view: callers share the cached data and can never modify it
+            return entry['frame'].copy(deep=False), self._versions[table]
+    
+    def is_truncated(self, table):
+        """Whether the cached table holds only the rows that fit the memory cap, not the whole table"""
+        entry = self._entries.get(table)
+        return bool(entry and entry['truncated'])
+    
+    def freshness(self):
+        """(oldest as-of time, serving any snapshot, refresh running) across loaded tables"""
+        entries = list(self._entries.values())
+        if not entries:
+            return None, False, False
+        return (min(entry['as_of'] for entry in entries),
+                any(entry['source'] == 'snapshot' for entry in entries),
+                any(entry['refreshing'] for entry in entries))
+    
+    def mark_stale(self, *tables):
+        """Force a delta pull on the next read of the given tables (all if none given)"""
+        for table in tables or self._loaders:
+            entry = self._entries.get(table)
+            if entry:
+                entry['stale'] = True
+    
+    def reload(self, *tables):
+        """Force a full reload on the next read, e.g. after deletes that deltas cannot see"""
+        for table in tables or self._loaders:
+            entry = self._entries.get(table)
+            if entry:
+                entry['reload'] = True
+    
+    def patch(self, table, rows):
+        """Merge rows returned by a write into the cached table without a round trip"""
+        if not isinstance(rows, list) or not rows:
+            # Nothing usable came back from the write; fall back to a delta pull
+            self.mark_stale(table)
+            return
+        with self._locks[table]:
+            self._versions[table] += 1
+            entry = self._entries.get(table)
+            if entry is not None:
+                self._set_frame(table, entry, self._merge(table, entry['frame'], pd.DataFrame(rows)))
+    
+    def remove(self, table, keys):
+        """Drop rows by primary key from the cached table"""
+        _, key = self.db.SYNC_SPECS[table]
+        with self._locks[table]:
+            self._versions[table] += 1
+            entry = self._entries.get(table)
+            if entry is not None and key in entry['frame'].columns:
+                frame = entry['frame']
+                self._set_frame(table, entry, frame[~frame[key].isin(keys)].reset_index(drop=True))
+    
+    def _set_frame(self, table, entry, frame):
+        frame = self.db.apply_schema(table, frame)
+        enricher = self.enrichers.get(table)
+        entry['frame'] = enricher(frame) if enricher and not frame.empty else frame
+        entry['enriched_on'] = datetime.now().date()
+    
+    def _new_entry(self, table, frame, source='database', as_of=None, mark=None):
+        now = time.monotonic()
+        entry = {
+            'mark': mark if mark is not None else self._high_water_mark(table, frame),
+            'loaded_at': now,
+            'synced_at': now,
+            'as_of': as_of or datetime.now(),
+            'source': source,
+            'refreshing': False,
+            'stale': False,
+            # An empty result may be a failed fetch; try again on the next read
+            'reload': frame.empty,
+            # Only the rows that fit the memory cap were fetched
+            'truncated': bool(frame.attrs.get('truncated', False)),
+        }
+        self._set_frame(table, entry, frame)
+        return entry
+    
+    def _full_load(self, table):
+        entry = self._new_entry(table, self._loaders[table]())
+        self._entries[table] = entry
+        self._versions[table] += 1
+        self._write_snapshot(table, entry)
+        return entry
+    
+    def _revalidate_in_background(self, table, entry):
+        if entry['refreshing']:
+            return
+        entry['refreshing'] = True
+        threading.Thread(target=self._revalidate, args=(table,), daemon=True,
+                         name=f"smis-revalidate-{table}").start()
+    
+    def _revalidate(self, table):
+        # Fetch outside the lock so readers keep getting the snapshot meanwhile
+        frame = self._loaders[table]()
+        with self._locks[table]:
+            current = self._entries[table]
+            if frame.empty and not current['frame'].empty:
+                # Most likely a failed fetch; keep the snapshot and retry on a later read
+                current['refreshing'] = False
+                return
+            entry = self._new_entry(table, frame)
+            # Writes patched into the snapshot meanwhile are re-read by a delta pull
+            entry['stale'] = True
+            self._entries[table] = entry
+            self._versions[table] += 1
+        self._write_snapshot(table, entry)
+    
+    def _snapshot_path(self, table):
+        return os.path.join(self.snapshot_dir, f"{table}.parquet")
+    
+    def _load_snapshot(self, table):
+        if not self.snapshot_dir or not os.path.exists(self._snapshot_path(table)):
+            return None
+        try:
+            snapshot = pq.read_table(self._snapshot_path(table))
+            meta = json.loads(snapshot.schema.metadata[b'smis'])
+            entry = self._new_entry(
+                table, snapshot.to_pandas(), source='snapshot',
+                as_of=datetime.fromisoformat(meta['as_of']),
+                mark=pd.Timestamp(meta['mark']) if meta['mark'] else None
+            )
+        except Exception:
+            return None
+        self._entries[table] = entry
+        self._versions[table] += 1
+        return entry
+    
+    def _write_snapshot(self, table, entry):
+        # A partial table must never come back as if complete on a cold start
+        if not self.snapshot_dir or entry['frame'].empty or entry['truncated']:
+            return
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            snapshot = pa.Table.from_pandas(entry['frame'], preserve_index=False)
+            meta = {'as_of': entry['as_of'].isoformat(),
+                    'mark': entry['mark'].isoformat() if entry['mark'] is not None else None}
+            snapshot = snapshot.replace_schema_metadata({**(snapshot.schema.metadata or {}),
+                                                         b'smis': json.dumps(meta).encode()})
+            # Write then rename so readers only ever see a complete snapshot
+            path = self._snapshot_path(table)
+            pq.write_table(snapshot, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except Exception:
+            # A snapshot only speeds up cold starts; never fail a load over it
+            pass
+    
+    def _pull_changes(self, table, entry):
+        entry['synced_at'] = time.monotonic()
+        entry['stale'] = False
+        if entry['mark'] is None:
+            entry['reload'] = True
+            return
+        
+        since = (entry['mark'] - self.OVERLAP).isoformat()
+        changes = self.db.get_changes(table, since)
+        entry['as_of'] = datetime.now()
+        if changes.empty:
+            return
+        if changes.attrs.get('truncated'):
+            # Moving the mark past a partial delta would lose the rest of it for good
+            entry['reload'] = True
+            return
+        
+        self._set_frame(table, entry, self._merge(table, entry['frame'], changes))
+        entry['mark'] = max(entry['mark'], self._high_water_mark(table, changes))
+        self._versions[table] += 1
+        self._write_snapshot(table, entry)
+    
+    def _merge(self, table, frame, changes):
+        """Upsert changed rows into the cached frame by primary key"""
+        _, key = self.db.SYNC_SPECS[table]
+        # Parse the changes first so sort keys never mix strings and timestamps
+        merged = pd.concat([frame, self.db.apply_schema(table, changes)], ignore_index=True)
+        if key in merged.columns:
+            merged = merged.drop_duplicates(subset=key, keep='last')
+        
+        keyset = self.db.KEYSETS.get(table)
+        sort_cols = [col for col in (keyset or (key,)) if col in merged.columns]
+        if sort_cols:
+            merged = merged.sort_values(sort_cols, ascending=not keyset)
+        return merged.reset_index(drop=True)
+    
+    def _high_water_mark(self, table, frame):
+        mark_col, _ = self.db.SYNC_SPECS[table]
+        if frame.empty or mark_col not in frame.columns:
+            return None
+        marks = pd.to_datetime(frame[mark_col], errors='coerce', utc=True)
+        return None if marks.isna().all() else marks.max()
+
+# Expiry buckets over days to expiry, as (lower, upper] bins
+EXPIRY_BINS = [-np.inf, 0, 30, 90, 180, np.inf]
+EXPIRY_BUCKETS = ["Expired", "≤ 30 Days", "31-90 Days", "91-180 Days", "> 180 Days"]
+NO_EXPIRY = "No Expiry"
+STOCK_STATUSES = ["Critical", "Low", "Adequate"]
+
+def enrich_inventory(inventory_df):
+    """Add expiry and stock-status columns, computed once per inventory data version"""
+    frame = inventory_df.copy(deep=False)
+    expiry_dates = frame['expiry_date'] if 'expiry_date' in frame.columns else pd.Series(None, index=frame.index)
+    frame['expiry_date_dt'] = pd.to_datetime(expiry_dates, errors='coerce')
+    frame['days_to_expiry'] = (frame['expiry_date_dt'] - pd.Timestamp.now()).dt.days
+    frame['expiry_status'] = (pd.cut(frame['days_to_expiry'], EXPIRY_BINS, labels=EXPIRY_BUCKETS)
+                              .cat.add_categories(NO_EXPIRY).fillna(NO_EXPIRY))
+    
+    quantity = pd.to_numeric(frame['quantity'], errors='coerce').fillna(0)
+    reorder_level = pd.to_numeric(frame.get('reorder_level'), errors='coerce')
+    frame['stock_status'] = pd.Categorical(
+        np.select([quantity <= 0, quantity <= reorder_level], STOCK_STATUSES[:2], STOCK_STATUSES[2]),
+        categories=STOCK_STATUSES
+    )
+    return frame
+
+class ItemSearchIndex:
+    """Inverted token index over inventory rows, with prefix and trigram (typo-tolerant) matching"""
+    # Field weights for ranking: an ID hit outranks a name hit, which outranks supplier and notes
+    FIELDS = {'item_id': 4.0, 'item_name': 3.0, 'supplier': 1.5, 'notes': 1.0}
+    PREFIX_SCORE = 0.8
+    FUZZY_SCORE = 0.6
+    MIN_SIMILARITY = 0.5
+    MAX_EXPANSIONS = 200
+    TOKEN_PATTERN = re.compile(r'[0-9a-z]+')
+    
+    def __init__(self, inventory_df):
+        self.size = len(inventory_df)
+        # token -> {row position: best field weight}
+        self.postings = {}
+        for field, weight in self.FIELDS.items():
+            if field not in inventory_df.columns:
+                continue
+            for row, value in enumerate(inventory_df[field].tolist()):
+                if value is None or value != value:
+                    continue
+                for token in self.tokenize(value):
+                    rows = self.postings.setdefault(token, {})
+                    if rows.get(row, 0) < weight:
+                        rows[row] = weight
+        
+        self.vocabulary = sorted(self.postings)
+        self.trigrams = {}
+        for token in self.vocabulary:
+            for gram in self._trigrams(token):
+                self.trigrams.setdefault(gram, []).append(token)
+    
+    @classmethod
+    def tokenize(cls, text):
+        return cls.TOKEN_PATTERN.findall(str(text).lower())
+    
+    @staticmethod
+    def _trigrams(token):
+        padded = f"  {token} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    def _expand(self, term):
+        """Vocabulary tokens matching a query term, with a match score each"""
+        matches = {}
+        if term in self.postings:
+            matches[term] = 1.0
+        
+        start = bisect.bisect_left(self.vocabulary, term)
+        for token in self.vocabulary[start:start + self.MAX_EXPANSIONS]:
+            if not token.startswith(term):
+                break
+            matches.setdefault(token, self.PREFIX_SCORE)
+        
+        # Typo tolerance only kicks in when the term matches nothing as typed
+        if not matches and len(term) >= 3:
+            grams = self._trigrams(term)
+            overlaps = Counter(token for gram in grams for token in self.trigrams.get(gram, ()))
+            for token, shared in overlaps.items():
+                similarity = 2 * shared / (len(grams) + len(token) + 1)
+                if similarity >= self.MIN_SIMILARITY:
+                    matches[token] = self.FUZZY_SCORE * similarity
+        return matches
+    
+    def search(self, query, limit=None):
+        """Row positions matching every query term, best match first"""
+        expansions = [self._expand(term) for term in dict.fromkeys(self.tokenize(query))]
+        if not expansions or not all(expansions):
+            return []
+        # Most selective terms first, so later terms only score the rows still in the running
+        expansions.sort(key=lambda matches: sum(len(self.postings[token]) for token in matches))
+        
+        scores = {}
+        for token, match_score in expansions[0].items():
+            for row, weight in self.postings[token].items():
+                scores[row] = max(scores.get(row, 0), match_score * weight)
+        
+        for matches in expansions[1:]:
+            narrowed = {}
+            for row, score in scores.items():
+                best = max(match_score * self.postings[token].get(row, 0) for token, match_score in matches.items())
+                if best:
+                    narrowed[row] = score + best
+            scores = narrowed
+            if not scores:
+                return []
+        
+        ranked = sorted(scores, key=lambda row: (-scores[row], row))
+        return ranked[:limit] if limit else ranked
+
+@st.cache_resource(max_entries=4)
+def load_search_index(version, _inventory_df):
+    """Search index for an inventory data version; the version must come with the frame, from data.version()"""
+    return ItemSearchIndex(_inventory_df)
+
+class ItemLookup:
+    """Inventory rows keyed by item_id for constant-time lookups, with the labels item pickers show"""
+    def __init__(self, inventory_df, version=None):
+        self.frame = inventory_df
+        # Data version of the frame, for other caches derived from the same rows
+        self.version = version
+        if inventory_df.empty or 'item_id' not in inventory_df.columns:
+            self.item_ids = []
+        else:
+            self.item_ids = inventory_df['item_id'].astype(str).tolist()
+        self.positions = {item_id: position for position, item_id in enumerate(self.item_ids)}
+        # Names repeat across suppliers and pack sizes, so every label carries the ID
+        names = inventory_df['item_name'].astype(str).tolist() if self.item_ids else []
+        self.labels = {item_id: f"{name} · {item_id}" for item_id, name in zip(self.item_ids, names)}
+        self.ids_by_label = {label: item_id for item_id, label in self.labels.items()}
+    
+    def __contains__(self, item_id):
+        return str(item_id) in self.positions
+    
+    def get(self, item_id):
+        """Inventory row for an item ID, or None when it is unknown"""
+        position = self.positions.get(str(item_id))
+        return None if position is None else self.frame.iloc[position]
+    
+    def label(self, item_id):
+        return self.labels.get(item_id, str(item_id))
+    
+    def column(self, item_ids, column):
+        """Values of ``column`` for a Series of item IDs, aligned with it; NaN for unknown IDs"""
+        positions = item_ids.map(self.positions)
+        known = positions.notna()
+        values = pd.Series(np.nan, index=item_ids.index, dtype=object)
+        values[known] = self.frame[column].iloc[positions[known].astype(int)].to_numpy()
+        return values
+
+@st.cache_resource(max_entries=4)
+def load_item_lookup(version, _inventory_df):
+    """Item lookup for an inventory data version; the version must come with the frame, from data.version()"""
+    return ItemLookup(_inventory_df, version)
+
+@st.cache_resource
+def get_table_sync():
+    """Shared delta-sync cache for all sessions"""
+    snapshot_dir = get_setting("SMIS_SNAPSHOT_DIR", ".snapshots")
+    # Snapshots are kept per backend so switching backends never serves foreign data
+    return TableSync(db, snapshot_dir=os.path.join(snapshot_dir, type(db).__name__.lower()) if snapshot_dir else None,
+                     enrichers={'inventory': enrich_inventory})
+
+table_sync = get_table_sync()
+
+class FrameStore:
+    """Process-wide LRU store of derived frames, shared read-only by all sessions within a memory budget"""
+    def __init__(self, budget_mb=64):
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self._frames = OrderedDict()
+        self._used_bytes = 0
+        self._lock = threading.Lock()
+    
+    def cached(self, ttl=None):
+        """Decorator memoizing a frame-returning function by its arguments, like st.cache_data but unpickled"""
+        def decorator(func):
+            def wrapper(*args):
+                return self.get_or_compute((func.__name__,) + args, lambda: func(*args), ttl)
+            return wrapper
+        return decorator
+    
+    @staticmethod
+    def _share(value):
+        # Sessions get shallow copies, so their column edits never reach the stored frame
+        if isinstance(value, tuple):
+            return tuple(FrameStore._share(item) for item in value)
+        return value.copy(deep=False) if isinstance(value, pd.DataFrame) else value
+    
+    @staticmethod
+    def _nbytes(value):
+        items = value if isinstance(value, tuple) else (value,)
+        return sum(int(item.memory_usage(deep=True).sum()) for item in items if isinstance(item, pd.DataFrame))
+    
+    def get_or_compute(self, key, compute, ttl=None):
+        """Shared frame (or tuple holding frames) for ``key``, computing it on a miss or once it is older
+        than ``ttl`` seconds"""
+        with self._lock:
+            hit = self._frames.get(key)
+            if hit and (ttl is None or time.monotonic() - hit['stored_at'] <= ttl):
+                self._frames.move_to_end(key)
+                return self._share(hit['frame'])
+        
+        # Computed outside the lock; two sessions missing together both compute, and the last one wins
+        frame = compute()
+        nbytes = self._nbytes(frame)
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old:
+                self._used_bytes -= old['nbytes']
+            self._frames[key] = {'frame': frame, 'nbytes': nbytes, 'stored_at': time.monotonic()}
+            self._used_bytes += nbytes
+            # Least recently used frames go first; the newest one is always kept
+            while self._used_bytes > self.budget_bytes and len(self._frames) > 1:
+                _, evicted = self._frames.popitem(last=False)
+                self._used_bytes -= evicted['nbytes']
+        return self._share(frame)
+    
+    def stats(self):
+        """Number of frames held and the memory they use"""
+        with self._lock:
+            return {'frames': len(self._frames), 'used_mb': self._used_bytes / 1024 / 1024,
+                    'budget_mb': self.budget_bytes / 1024 / 1024}
+
+@st.cache_resource
+def get_frame_store():
+    """Derived-frame store shared by all sessions"""
+    return FrameStore(budget_mb=float(get_setting("SMIS_DERIVED_CACHE_MB", 64)))
+
+frame_store = get_frame_store()
+
+def load_inventory_data():
+    """Load inventory data from Supabase"""
+    return table_sync.get('inventory')
+
+def load_receipts_data():
+    """Load receipts data from Supabase"""
+    return table_sync.get('receipts')
+
+def load_issues_data():
+    """Load issues data from Supabase"""
+    return table_sync.get('issues')
+
+@st.cache_data(ttl=60)
+def load_inventory_kpis(version):
+    """Load dashboard KPIs for an inventory data version"""
+    return db.get_inventory_kpis(fallback=load_inventory_data)
+
+@frame_store.cached(ttl=60)
+def load_category_totals(version):
+    """Load per-category totals for an inventory data version"""
+    return db.get_category_totals(fallback=load_inventory_data)
+
+@frame_store.cached(ttl=60)
+def load_low_stock_items(version):
+    """Load low stock items for an inventory data version"""
+    return db.get_low_stock_items(fallback=load_inventory_data)
+
+def build_category_bar(category_units):
+    """Bar chart of units per category"""
+    fig = px.bar(
+        category_units,
+        x='category',
+        y='quantity',
+        color='quantity',
+        color_continuous_scale='Viridis',
+        text='quantity'
+    )
+    fig.update_layout(height=400, plot_bgcolor='white', paper_bgcolor='white')
+    fig.update_traces(texttemplate='%{text:,}', textposition='outside')
+    return fig
+
+def build_category_pie(category_units):
+    """Donut chart of the stock split across categories"""
+    fig = px.pie(
+        category_units,
+        values='quantity',
+        names='category',
+        hole=0.4
+    )
+    fig.update_layout(height=400)
+    return fig
+
+# Dashboard charts drawn from the per-category totals, by chart name
+CATEGORY_CHARTS = {
+    'units_by_category': build_category_bar,
+    'stock_distribution': build_category_pie,
+}
+
+@st.cache_resource(max_entries=16)
+def build_category_chart(chart, digest, _category_units):
+    """Build a category chart once per distinct set of totals; the figure is shared and must not be modified"""
+    return CATEGORY_CHARTS[chart](_category_units)
+
+def load_category_chart(chart, version):
+    """Category chart for an inventory data version"""
+    # Keyed on the totals themselves: they refresh with their own ttl even when
+    # another process changed the stock and the local version has not moved
+    category_units = load_category_totals(version)
+    digest = hashlib.sha1(pd.util.hash_pandas_object(category_units, index=False).to_numpy()).hexdigest()
+    return build_category_chart(chart, digest, category_units)
+
+# Inventories larger than this are browsed page by page, with filtering and sorting done by the database
+GRID_THRESHOLD = int(get_setting("SMIS_GRID_THRESHOLD", 1000))
+# Row count method for grid pages: exact, planned or estimated (cheaper on very large tables)
+GRID_COUNT = get_setting("SMIS_GRID_COUNT", "exact")
+
+@frame_store.cached(ttl=60)
+def load_inventory_page(filters, sort, descending, offset, limit, version):
+    """Load one inventory grid page and its match count for an inventory data version;
+    ``filters`` is a tuple of (column, value) pairs so it can key the store"""
+    return db.get_inventory_page(dict(filters), sort, descending, offset, limit, count=GRID_COUNT,
+                                 fallback=load_inventory_data)
+
+def export_inventory_grid(filters, sort, descending):
+    """CSV of every inventory row matching the grid filters, written page by page"""
+    buffer = io.StringIO()
+    for number, page in enumerate(db.iter_inventory_grid(filters, sort, descending, fallback=load_inventory_data)):
+        page.to_csv(buffer, header=number == 0, index=False)
+    return buffer.getvalue()
+
+def export_table(table):
+    """CSV of a whole table, written page by page when an export is asked for"""
+    buffer = io.StringIO()
+    try:
+        for number, page in enumerate(db.iter_table(table)):
+            page.to_csv(buffer, header=number == 0, index=False)
+    except Exception as e:
+        st.error(f"Error exporting {table}: {e}")
+        return None
+    return buffer.getvalue()
+
+@st.cache_data(ttl=60)
+def load_movement_totals(receipts_version, issues_version):
+    """Load receipt and issue totals for the given ledger data versions"""
+    return db.get_movement_totals(fallback=lambda: (load_receipts_data(), load_issues_data()))
+
+@frame_store.cached(ttl=60)
+def load_receipts_window(start_date, end_date, version):
+    """Load receipts for a date window; ``version`` keys the cache to the receipts data version"""
+    return db.apply_schema('receipts', db.get_receipts_between(start_date, end_date))
+
+@frame_store.cached(ttl=60)
+def load_issues_window(start_date, end_date, version):
+    """Load issues for a date window; ``version`` keys the cache to the issues data version"""
+    return db.apply_schema('issues', db.get_issues_between(start_date, end_date))
+
+# Per-table load deadlines in seconds
+LOAD_TIMEOUTS = {
+    'inventory': float(get_setting("SMIS_INVENTORY_TIMEOUT", 20)),
+    'receipts': float(get_setting("SMIS_RECEIPTS_TIMEOUT", 30)),
+    'issues': float(get_setting("SMIS_ISSUES_TIMEOUT", 30)),
+}
+
+@st.cache_resource
+def get_load_pool():
+    """Thread pool shared by all sessions for concurrent table loads"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix='smis-load')
+
+def load_tables(*tables):
+    """Fetch tables concurrently with their data versions; a table that fails or misses its
+    deadline comes back empty, with version None"""
+    ctx = get_script_run_ctx()
+    
+    def load(table):
+        # Lets fetch errors raised inside the loader still render on this page
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return table_sync.snapshot(table)
+    
+    started = time.monotonic()
+    futures = {table: get_load_pool().submit(load, table) for table in tables}
+    frames, versions, failed = {}, {}, []
+    for table, future in futures.items():
+        remaining = LOAD_TIMEOUTS[table] - (time.monotonic() - started)
+        try:
+            frames[table], versions[table] = future.result(timeout=max(remaining, 0))
+        except Exception:
+            frames[table], versions[table] = pd.DataFrame(), None
+            failed.append(table)
+    return frames, versions, failed
+
+class LazyTables:
+    """Loads tables on first access and memoizes them for the rest of the rerun"""
+    def __init__(self):
+        self._frames = {}
+        self._versions = {}
+    
+    def prefetch(self, *tables):
+        """Fetch any of the given tables not loaded yet, concurrently"""
+        missing = [table for table in tables if table not in self._frames]
+        if not missing:
+            return
+        frames, versions, failed = load_tables(*missing)
+        self._frames.update(frames)
+        self._versions.update(versions)
+        for table in failed:
+            st.warning(f"⚠️ {table.title()} could not be loaded in time. Views that need it may be incomplete; "
+                       f"use 🔄 Refresh Data to retry.")
+    
+    def __getitem__(self, table):
+        self.prefetch(table)
+        return self._frames[table]
+    
+    def version(self, table):
+        """Data version of the rows this rerun got for a table; keys caches derived from them"""
+        self.prefetch(table)
+        return self._versions[table]
+
+# ========== STOCK MOVEMENT HELPERS ==========
+def apply_movement_result(kind, result):
+    """Patch the shared table caches with the rows a stock movement wrote"""
+    table_sync.patch('inventory', result['items'])
+    table_sync.patch(db.LEDGERS[kind], result['entries'])
+
+@st.cache_resource
+def get_movement_outbox():
+    """Process-wide offline movement queue, replayed in the background"""
+    outbox = MovementOutbox(get_setting("SMIS_OUTBOX_PATH", "smis_outbox.db"),
+                            interval=float(get_setting("SMIS_OUTBOX_INTERVAL", 15)))
+    outbox.start(db, apply_movement_result)
+    return outbox
+
+outbox = get_movement_outbox()
+
+@st.cache_resource
+def get_item_id_allocator():
+    """Process-wide item ID allocator, so sessions draw on shared number blocks"""
+    return ItemIdAllocator(db, block_size=int(get_setting("SMIS_ID_BLOCK_SIZE", 10)))
+
+item_id_allocator = get_item_id_allocator()
+
+def submit_stock_movements(kind, entries, username):
+    """Record a voucher, queueing it offline if the backend is unreachable; returns (status, result)"""
+    voucher = uuid.uuid4().hex
+    # The client_ref makes a replay of the same line a no-op on the server
+    entries = [{**entry, 'client_ref': f"{voucher}-{line}"} for line, entry in enumerate(entries, 1)]
+    success, result = db.record_stock_movements(kind, entries, username)
+    if success:
+        apply_movement_result(kind, result)
+        return 'recorded', result
+    if isinstance(result, BackendUnavailable):
+        outbox.enqueue(kind, entries, username, voucher)
+        return 'queued', result
+    return 'failed', result
+
+def validate_movement_lines(kind, lines, lookup):
+    """Validate multi-line voucher rows in one vectorized pass; returns (lines, errors)"""
+    # Rows the clerk added but left blank are ignored
+    lines = lines.dropna(subset=['item']).reset_index(drop=True)
+    if lines.empty:
+        return lines, ["Add at least one line with an item."]
+    
+    errors = []
+    line_no = lines.index + 1
+    lines['item_id'] = lines['item'].map(lookup.ids_by_label)
+    lines['item_name'] = lookup.column(lines['item_id'], 'item_name')
+    lines['quantity'] = pd.to_numeric(lines['quantity'], errors='coerce').fillna(0).astype(int)
+    
+    unknown = lines['item_id'].isna()
+    errors += [f"Line {n}: '{item}' is not in inventory" for n, item in zip(line_no[unknown], lines['item'][unknown])]
+    bad_quantity = lines['quantity'] <= 0
+    errors += [f"Line {n}: quantity must be greater than 0" for n in line_no[bad_quantity]]
+    
+    if kind == 'receipt':
+        lines['unit_cost'] = pd.to_numeric(lines['unit_cost'], errors='coerce').fillna(0.0).astype(float)
+        bad_cost = lines['unit_cost'] <= 0
+        errors += [f"Line {n}: unit cost must be greater than 0" for n in line_no[bad_cost]]
+        lines['total_value'] = lines['quantity'] * lines['unit_cost']
+    else:
+        # Several lines may draw on the same item, so compare the per-item total
+        available = pd.to_numeric(lookup.column(lines['item_id'], 'quantity'), errors='coerce').fillna(0).astype(int)
+        requested = lines.groupby('item_id', dropna=False)['quantity'].transform('sum')
+        short = ~unknown & (requested > available)
+        errors += [f"Line {n}: {name} has only {a} available ({r} requested in total)"
+                   for n, name, a, r in zip(line_no[short], lines['item_name'][short], available[short], requested[short])]
+    
+    return lines, errors
+
+# ========== ITEM PICKER ==========
+# Most picker options sent to the browser per render
+PICKER_LIMIT = int(get_setting("SMIS_PICKER_LIMIT", 50))
+
+def find_item_candidates(query, inventory_df, lookup):
+    """Item IDs matching a picker query: the local search index first, then the database"""
+    # A truncated table lacks items past the memory cap, so only the database can answer
+    if not table_sync.is_truncated('inventory'):
+        # The lookup was built from this same frame, so its version keys the index too
+        search_index = load_search_index(lookup.version, inventory_df)
+        item_ids = [lookup.item_ids[position] for position in search_index.search(query, limit=PICKER_LIMIT)]
+        if item_ids:
+            return item_ids
+    
+    # Substring matches inside words, and items created since the last sync, only the database knows
+    found = db.search_inventory(query, limit=PICKER_LIMIT)
+    if found.empty or 'item_id' not in found.columns:
+        return []
+    found_ids = found['item_id'].astype(str).tolist()
+    if not all(item_id in lookup for item_id in found_ids):
+        table_sync.patch('inventory', found.to_dict('records'))
+        st.rerun()
+    return found_ids
+
+def item_query_input(key):
+    """Search box of an item picker"""
+    # A text input reruns on Enter or blur, never per keystroke, which debounces the search
+    return st.text_input("🔍 Find item", key=f"{key}_item_query",
+                         placeholder="Type part of a name or ID and press Enter").strip()
+
+def item_picker(label, key, inventory_df, lookup):
+    """Type-ahead item picker returning an item ID; only matching candidates are sent to the browser"""
+    query = item_query_input(key)
+    
+    if query:
+        options = find_item_candidates(query, inventory_df, lookup)
+        if not options:
+            st.caption(f"No items match '{query}'.")
+    else:
+        options = lookup.item_ids[:PICKER_LIMIT]
+        if len(lookup.item_ids) > PICKER_LIMIT:
+            st.caption(f"Showing the first {PICKER_LIMIT} of {len(lookup.item_ids)} items; search to find others.")
+    
+    if not options:
+        return None
+    
+    # A search preselects its best hit; the unsearched list needs an explicit pick. The selectbox
+    # keeps the clerk's own choice across reruns, and a new search replaces it with the new hits.
+    return st.selectbox(label, options, index=0 if query else None, format_func=lookup.label)
 
-# ========== CHECK AUTHENTICATION ==========
-user = auth.check_auth()
+def remote_item_picker(label, key):
+    """Type-ahead item picker that searches the database, for stores too large to load whole;
+    returns the picked inventory row"""
+    query = item_query_input(key)
+    if not query:
+        st.caption("Search to find an item.")
+        return None
+    found = db.search_inventory(query, limit=PICKER_LIMIT)
+    if found.empty or 'item_id' not in found.columns:
+        st.caption(f"No items match '{query}'.")
+        return None
+    lookup = ItemLookup(found.reset_index(drop=True))
+    item_id = st.selectbox(label, lookup.item_ids, index=0, format_func=lookup.label)
+    return lookup.get(item_id)
 
-# ========== LOAD DATA FROM SUPABASE ==========
-@st.cache_data(ttl=60)  # Cache for 60 seconds
-def load_inventory_data():
-    """Load inventory data from Supabase"""
-    return db.get_inventory()
+def apply_editor_changes(frame, changes):
+    """Fold the edits a data_editor keeps in session state into the frame it was rendered from"""
+    changes = changes or {}
+    frame = frame.copy()
+    for row, values in changes.get('edited_rows', {}).items():
+        for column, value in values.items():
+            frame.iloc[int(row), frame.columns.get_loc(column)] = value
+    frame = frame.drop(index=frame.index[list(changes.get('deleted_rows', []))])
+    added = pd.DataFrame(changes.get('added_rows', []), columns=frame.columns)
+    if added.empty:
+        return frame.reset_index(drop=True)
+    return pd.concat([frame, added], ignore_index=True)
 
-@st.cache_data(ttl=60)
-def load_receipts_data():
-    """Load receipts data from Supabase"""
-    return db.get_receipts()
+def add_voucher_line(key, label, defaults):
+    """Append a picked item to a voucher draft, keeping the edits already made to its lines"""
+    draft_key = f"{key}_draft"
+    draft = apply_editor_changes(st.session_state[draft_key], st.session_state.get(f"{key}_lines"))
+    st.session_state[draft_key] = pd.concat([draft, pd.DataFrame([{'item': label, **defaults}])],
+                                            ignore_index=True)
 
-@st.cache_data(ttl=60)
-def load_issues_data():
-    """Load issues data from Supabase"""
-    return db.get_issues()
+def clear_voucher_lines(key):
+    """Drop a voucher draft once its lines are recorded"""
+    st.session_state.pop(f"{key}_draft", None)
 
-# Load data
-inventory_df = load_inventory_data()
-receipts_df = load_receipts_data()
-issues_df = load_issues_data()
+def voucher_lines_editor(key, inventory_df, lookup, column_config, defaults):
+    """Multi-line voucher editor; items are added through the type-ahead picker, so the grid never
+    carries the full item list"""
+    draft_key = f"{key}_draft"
+    if draft_key not in st.session_state:
+        st.session_state[draft_key] = pd.DataFrame(
+            {'item': pd.Series(dtype='object'),
+             **{column: pd.Series(dtype=type(value)) for column, value in defaults.items()}})
+    
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        item_id = item_picker("Item to add", key, inventory_df, lookup)
+    with col2:
+        st.button("➕ Add Line", key=f"{key}_add_line", disabled=item_id is None,
+                  on_click=add_voucher_line, args=(key, lookup.label(item_id) if item_id else None, defaults))
+    
+    # Lines are edited or deleted in place; new ones only come from the picker
+    return st.data_editor(
+        st.session_state[draft_key],
+        num_rows="dynamic",
+        use_container_width=True,
+        column_config={'item': st.column_config.TextColumn("Item*", disabled=True), **column_config},
+        key=f"{key}_lines"
+    )
 
 # ========== SIDEBAR USER INFO ==========
 with st.sidebar:
@@ -476,8 +3272,19 @@ with st.sidebar:
     st.markdown("### ⚡ Quick Actions")
     
     if st.button("🔄 Refresh Data", use_container_width=True, type="secondary"):
-        st.cache_data.clear()
+        table_sync.reload()
         st.rerun()
+    # Filled in at the end of the run, once this page's tables are loaded
+    freshness_slot = st.empty()
+    
+    queued = outbox.counts()
+    if queued['pending'] and st.button("📤 Sync Queued Movements", use_container_width=True, type="secondary"):
+        if outbox.replay(db, apply_movement_result) is not None:
+            queued = outbox.counts()
+    if queued['pending']:
+        st.caption(f"📤 {queued['pending']} stock movement line(s) saved offline, waiting to sync")
+    if queued['failed']:
+        st.caption(f"⚠️ {queued['failed']} offline line(s) were rejected on sync; see Settings → System Info")
     
     if st.button("🚪 Logout", use_container_width=True, type="secondary"):
         auth.logout()
@@ -504,30 +3311,39 @@ selected_tab = st.radio(
     label_visibility="collapsed"
 )
 
+# Tables each tab renders from. Dashboard, Reports and System Info use aggregates
+# (exports fetch their table on request), history tabs query their own date window,
+# and Inventory loads its table only when the store is small enough to browse in memory.
+TAB_DATA = {
+    "🏠 Dashboard": (),
+    "📦 Inventory": (),
+    "📥 Stock In": ('inventory',),
+    "📤 Stock Out": ('inventory',),
+    "⏰ Expiry": ('inventory',),
+    "📝 Reports": (),
+    "⚙️ Settings": (),
+}
+
+data = LazyTables()
+data.prefetch(*TAB_DATA[selected_tab])
+
 # DASHBOARD TAB
 if selected_tab == "🏠 Dashboard":
     st.markdown('<div class="section-header"><h2>Dashboard Overview</h2></div>', unsafe_allow_html=True)
     
-    # Calculate expiry metrics
-    if not inventory_df.empty and 'expiry_date' in inventory_df.columns:
-        inventory_df['expiry_date_dt'] = pd.to_datetime(inventory_df['expiry_date'], errors='coerce')
-        current_date = pd.Timestamp.now()
-        inventory_df['days_to_expiry'] = (inventory_df['expiry_date_dt'] - current_date).dt.days
-        
-        expired_count = (inventory_df['days_to_expiry'] <= 0).sum()
-        expiring_30_count = ((inventory_df['days_to_expiry'] > 0) & (inventory_df['days_to_expiry'] <= 30)).sum()
-    else:
-        expired_count = 0
-        expiring_30_count = 0
+    # KPIs, category totals and the low stock list are aggregated by the database
+    inventory_version = table_sync.version('inventory')
+    kpis = load_inventory_kpis(inventory_version)
+    category_units = load_category_totals(inventory_version)
     
     # Key Metrics Row
     col1, col2, col3, col4 = st.columns(4)
     
     metrics_data = [
-        ("Total Items", len(inventory_df) if not inventory_df.empty else 0, "📦", "Total number of unique items"),
-        ("Total Units", f"{inventory_df['quantity'].sum():,}" if not inventory_df.empty and 'quantity' in inventory_df.columns else "0", "📈", "Total units across all items"),
-        ("Low Stock", len(inventory_df[(inventory_df['quantity'] <= inventory_df['reorder_level']) & (inventory_df['quantity'] > 0)]) if not inventory_df.empty and 'quantity' in inventory_df.columns and 'reorder_level' in inventory_df.columns else 0, "⚠️", "Items at or below reorder level"),
-        ("Expiring Soon", expiring_30_count, "⏰", "Items expiring within 30 days")
+        ("Total Items", kpis['total_items'], "📦", "Total number of unique items"),
+        ("Total Units", f"{kpis['total_units']:,}", "📈", "Total units across all items"),
+        ("Low Stock", kpis['low_stock'], "⚠️", "Items at or below reorder level"),
+        ("Expiring Soon", kpis['expiring_30'], "⏰", "Items expiring within 30 days")
     ]
     
     for col, (label, value, icon, tooltip) in zip([col1, col2, col3, col4], metrics_data):
@@ -543,69 +3359,50 @@ if selected_tab == "🏠 Dashboard":
     st.markdown("---")
     
     # Charts Row
-    if not inventory_df.empty:
+    if not category_units.empty:
         col1, col2 = st.columns(2)
         
         with col1:
             st.markdown("#### 📈 Units by Category")
-            if 'category' in inventory_df.columns and 'quantity' in inventory_df.columns:
-                category_units = inventory_df.groupby('category')['quantity'].sum().reset_index()
-                if not category_units.empty:
-                    fig = px.bar(
-                        category_units,
-                        x='category',
-                        y='quantity',
-                        color='quantity',
-                        color_continuous_scale='Viridis',
-                        text='quantity'
-                    )
-                    fig.update_layout(height=400, plot_bgcolor='white', paper_bgcolor='white')
-                    fig.update_traces(texttemplate='%{text:,}', textposition='outside')
-                    st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(load_category_chart('units_by_category', inventory_version),
+                            use_container_width=True)
         
         with col2:
             st.markdown("#### 📦 Stock Distribution")
-            if 'category' in inventory_df.columns and 'quantity' in inventory_df.columns:
-                fig = px.pie(
-                    inventory_df,
-                    values='quantity',
-                    names='category',
-                    hole=0.4
-                )
-                fig.update_layout(height=400)
-                st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(load_category_chart('stock_distribution', inventory_version),
+                            use_container_width=True)
     
     st.markdown("---")
     
     # Low Stock Alert
     st.markdown("#### ⚠️ Low Stock Items Requiring Attention")
     
-    if not inventory_df.empty and 'quantity' in inventory_df.columns and 'reorder_level' in inventory_df.columns:
-        low_stock_items = inventory_df[inventory_df['quantity'] <= inventory_df['reorder_level']]
-        
-        if not low_stock_items.empty:
-            display_cols = ['item_name', 'category', 'quantity', 'unit', 'reorder_level']
-            display_df = low_stock_items[[col for col in display_cols if col in low_stock_items.columns]].copy()
-            
-            st.dataframe(display_df, use_container_width=True)
-        else:
-            st.success("✅ No low stock items at the moment!")
+    low_stock_items = load_low_stock_items(inventory_version)
+    
+    if not low_stock_items.empty:
+        st.dataframe(low_stock_items, use_container_width=True)
+    else:
+        st.success("✅ No low stock items at the moment!")
 
 # INVENTORY TAB
 elif selected_tab == "📦 Inventory":
     st.markdown('<div class="section-header"><h2>📦 Inventory Management</h2></div>', unsafe_allow_html=True)
     
+    # Large stores are paged by the database and never loaded whole; the item count comes from the aggregates
+    inventory_version = table_sync.version('inventory')
+    grid_mode = (load_inventory_kpis(inventory_version)['total_items'] > GRID_THRESHOLD
+                 or table_sync.is_truncated('inventory'))
+    inventory_df = pd.DataFrame() if grid_mode else data['inventory']
+    
     tab1, tab2, tab3 = st.tabs(["View Inventory", "Add Item", "Edit/Delete Item"])
     
     with tab1:
         # Filters
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            search = st.text_input("🔍 Search items", placeholder="Name or ID...")
+            search = st.text_input("🔍 Search items", placeholder="Name, ID, supplier or notes...")
         with col2:
-            categories = ["All"]
-            if not inventory_df.empty and 'category' in inventory_df.columns:
-                categories += sorted(inventory_df['category'].unique().tolist())
+            categories = ["All"] + sorted(load_category_totals(inventory_version)['category'].astype(str).tolist())
             category_filter = st.selectbox("Filter by Category", categories)
         with col3:
             status_filter = st.selectbox("Stock Status", ["All", "Adequate", "Low", "Critical"])
@@ -613,69 +3410,112 @@ elif selected_tab == "📦 Inventory":
             expiry_filter = st.selectbox("Expiry Status", 
                                        ["All", "Expired", "≤ 30 Days", "≤ 90 Days", "> 90 Days", "No Expiry"])
         
-        # Apply filters
-        filtered = inventory_df.copy()
-        if search and not inventory_df.empty:
-            if 'item_name' in inventory_df.columns:
-                filtered = filtered[filtered['item_name'].str.contains(search, case=False, na=False)]
-        
-        if category_filter != "All" and 'category' in filtered.columns:
-            filtered = filtered[filtered['category'] == category_filter]
-        
-        # Calculate days to expiry for filtering
-        if not filtered.empty and 'expiry_date' in filtered.columns:
-            filtered['expiry_date_dt'] = pd.to_datetime(filtered['expiry_date'], errors='coerce')
-            current_date = pd.Timestamp.now()
-            filtered['days_to_expiry'] = (filtered['expiry_date_dt'] - current_date).dt.days
-        
-        # Apply stock status filter
-        if status_filter != "All" and 'quantity' in filtered.columns and 'reorder_level' in filtered.columns:
-            if status_filter == "Low":
-                filtered = filtered[filtered['quantity'] <= filtered['reorder_level']]
-            elif status_filter == "Critical":
-                filtered = filtered[filtered['quantity'] == 0]
-            elif status_filter == "Adequate":
-                filtered = filtered[filtered['quantity'] > filtered['reorder_level']]
-        
-        # Apply expiry status filter
-        if expiry_filter != "All" and 'days_to_expiry' in filtered.columns:
-            if expiry_filter == "Expired":
-                filtered = filtered[filtered['days_to_expiry'] <= 0]
-            elif expiry_filter == "≤ 30 Days":
-                filtered = filtered[(filtered['days_to_expiry'] > 0) & (filtered['days_to_expiry'] <= 30)]
-            elif expiry_filter == "≤ 90 Days":
-                filtered = filtered[(filtered['days_to_expiry'] > 0) & (filtered['days_to_expiry'] <= 90)]
-            elif expiry_filter == "> 90 Days":
-                filtered = filtered[filtered['days_to_expiry'] > 90]
-            elif expiry_filter == "No Expiry":
-                filtered = filtered[pd.isna(filtered['expiry_date'])]
-        
-        # Display with formatting
-        if not filtered.empty:
-            display_cols = ['item_id', 'item_name', 'category', 'quantity', 'unit']
-            if 'storage_location' in filtered.columns:
-                display_cols.append('storage_location')
-            if 'expiry_date' in filtered.columns:
-                display_cols.append('expiry_date')
-            
-            display_df = filtered[[col for col in display_cols if col in filtered.columns]].copy()
+        # Expiry filter options as sets of expiry buckets
+        expiry_filters = {
+            "Expired": ["Expired"],
+            "≤ 30 Days": ["≤ 30 Days"],
+            "≤ 90 Days": ["≤ 30 Days", "31-90 Days"],
+            "> 90 Days": ["91-180 Days", "> 180 Days"],
+            "No Expiry": [NO_EXPIRY],
+        }
+        
+        if grid_mode:
+            # Large stores: the database filters, sorts and pages, and only one page reaches the browser
+            filters = {}
+            if search:
+                filters['search'] = search
+            if category_filter != "All":
+                filters['category'] = category_filter
+            if status_filter != "All":
+                filters['stock_status'] = status_filter
+            if expiry_filter != "All":
+                filters['expiry_status'] = tuple(expiry_filters[expiry_filter])
             
-            # Format expiry date
-            if 'expiry_date' in display_df.columns:
-                display_df['expiry_date'] = pd.to_datetime(display_df['expiry_date']).dt.strftime('%Y-%m-%d')
+            sort_options = {"Name": 'item_name', "Item ID": 'item_id', "Category": 'category',
+                            "Quantity": 'quantity', "Expiry Date": 'expiry_date'}
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                sort_by = st.selectbox("Sort by", list(sort_options))
+            with col2:
+                descending = st.checkbox("Descending", value=False)
+            with col3:
+                page_size = st.selectbox("Rows per page", [25, 50, 100], index=1)
+            with col4:
+                page = st.number_input("Page", min_value=1, value=1, step=1, key="inventory_page")
             
-            st.dataframe(display_df, use_container_width=True)
+            offset = (page - 1) * page_size
+            page_key = (tuple(filters.items()), sort_options[sort_by], descending)
+            page_df, total = load_inventory_page(*page_key, offset, page_size, inventory_version)
+            if page_df.empty and total:
+                # Past the end after the filters narrowed; show the last page instead
+                offset = (total - 1) // page_size * page_size
+                page_df, total = load_inventory_page(*page_key, offset, page_size, inventory_version)
             
-            # Export
-            csv = filtered.to_csv(index=False)
-            st.download_button(
-                "📥 Export Filtered Data",
-                data=csv,
-                file_name="filtered_inventory.csv",
-                mime="text/csv"
-            )
+            if not page_df.empty:
+                display_df = page_df.copy()
+                if 'expiry_date' in display_df.columns:
+                    display_df['expiry_date'] = pd.to_datetime(display_df['expiry_date'], errors='coerce').dt.strftime('%Y-%m-%d')
+                st.dataframe(display_df, use_container_width=True, hide_index=True)
+                estimated = "" if GRID_COUNT == "exact" else " (estimated)"
+                st.caption(f"Rows {offset + 1:,}–{offset + len(page_df):,} of {total:,}{estimated} · "
+                           f"page {offset // page_size + 1} of {max(1, -(-total // page_size)):,}")
+                
+                # The export covers every matching row, so it is only fetched, page by page, on request
+                if st.button("📥 Export Filtered Data"):
+                    with st.spinner(f"Exporting {total:,} rows..."):
+                        csv = export_inventory_grid(filters, sort_options[sort_by], descending)
+                    st.download_button(
+                        "💾 Download CSV",
+                        data=csv,
+                        file_name="filtered_inventory.csv",
+                        mime="text/csv",
+                        on_click="ignore"
+                    )
+            else:
+                st.info("No items match your filters or inventory is empty.")
         else:
-            st.info("No items match your filters or inventory is empty.")
+            # Apply filters; stock and expiry status are precomputed columns of the cached table
+            filtered = inventory_df
+            if search and not inventory_df.empty:
+                search_index = load_search_index(data.version('inventory'), inventory_df)
+                # Matches come back best first, and the remaining filters keep that order
+                filtered = filtered.iloc[search_index.search(search)]
+            
+            if category_filter != "All" and 'category' in filtered.columns:
+                filtered = filtered[filtered['category'] == category_filter]
+            
+            if status_filter != "All" and 'stock_status' in filtered.columns:
+                filtered = filtered[filtered['stock_status'] == status_filter]
+            
+            if expiry_filter != "All" and 'expiry_status' in filtered.columns:
+                filtered = filtered[filtered['expiry_status'].isin(expiry_filters[expiry_filter])]
+            
+            # Display with formatting
+            if not filtered.empty:
+                display_cols = ['item_id', 'item_name', 'category', 'quantity', 'unit']
+                if 'storage_location' in filtered.columns:
+                    display_cols.append('storage_location')
+                if 'expiry_date' in filtered.columns:
+                    display_cols.append('expiry_date')
+                
+                display_df = filtered[[col for col in display_cols if col in filtered.columns]].copy()
+                
+                # Format expiry date
+                if 'expiry_date' in display_df.columns:
+                    display_df['expiry_date'] = filtered['expiry_date_dt'].dt.strftime('%Y-%m-%d')
+                
+                st.dataframe(display_df, use_container_width=True)
+                
+                # Export
+                csv = filtered.to_csv(index=False)
+                st.download_button(
+                    "📥 Export Filtered Data",
+                    data=csv,
+                    file_name="filtered_inventory.csv",
+                    mime="text/csv"
+                )
+            else:
+                st.info("No items match your filters or inventory is empty.")
     
     with tab2:
         st.markdown("#### ➕ Add New Item")
@@ -685,17 +3525,12 @@ elif selected_tab == "📦 Inventory":
             
             with col1:
                 item_name = st.text_input("Item Name*", placeholder="e.g., A4 Duplicating Paper")
-                category = st.selectbox("Category*", 
-                                      ["Stationery", "Comp/Printer/Accessories", "Miscellaneous", 
-                                       "Electrical Items", "Motor Parts", "Vehicle Parts - Toyota Hilux",
-                                       "Fuel & Lubricants", "Laboratory Items", "Medical Supplies", "Office Equipment"])
+                category = st.selectbox("Category*", ITEM_CATEGORIES)
                 quantity = st.number_input("Quantity (Units)*", min_value=0, value=0, step=1)
             
             with col2:
-                unit = st.selectbox("Unit*", ["Units", "Pieces", "Reams", "Packets", "Boxes", 
-                                            "Bottles", "Litre", "Gallon", "Pairs", "Tin", "Rolls", "Cartons"])
-                storage_location = st.selectbox("Storage Location", 
-                                              ["Main Store", "Lab A", "Lab B", "Cold Room", "Quarantine", "Archive", "Warehouse"])
+                unit = st.selectbox("Unit*", ITEM_UNITS)
+                storage_location = st.selectbox("Storage Location", STORAGE_LOCATIONS)
                 
                 expiry_option = st.radio("Has expiry date?", ["No", "Yes"])
                 if expiry_option == "Yes":
@@ -715,43 +3550,51 @@ elif selected_tab == "📦 Inventory":
                 if not item_name:
                     st.error("Item Name is required!")
                 else:
-                    item_id = f"STR-{category[:3].upper()}-{datetime.now().strftime('%Y%m%d')}-{len(inventory_df)+1:04d}"
-                    
-                    item_data = {
-                        'item_id': item_id,
-                        'item_name': item_name,
-                        'category': category,
-                        'quantity': quantity,
-                        'unit': unit,
-                        'storage_location': storage_location,
-                        'reorder_level': reorder_level,
-                        'supplier': supplier,
-                        'notes': notes,
-                        'created_date': datetime.now().isoformat(),
-                        'created_by': user['username']
-                    }
-                    
-                    if expiry_date:
-                        item_data['expiry_date'] = expiry_date
-                    
-                    success, result = db.create_inventory_item(item_data)
-                    
-                    if success:
-                        st.success(f"✅ Item '{item_name}' added successfully!")
-                        st.cache_data.clear()
-                        st.rerun()
+                    # IDs come from a database counter, so concurrent adds never collide
+                    allocated, item_ids = item_id_allocator.allocate(category)
+                    if not allocated:
+                        st.error(f"❌ Error adding item: could not allocate an item ID: {item_ids}")
                     else:
-                        st.error(f"❌ Error adding item: {result}")
+                        item_data = {
+                            'item_id': item_ids[0],
+                            'item_name': item_name,
+                            'category': category,
+                            'quantity': quantity,
+                            'unit': unit,
+                            'storage_location': storage_location,
+                            'reorder_level': reorder_level,
+                            'supplier': supplier,
+                            'notes': notes,
+                            'created_date': datetime.now().isoformat(),
+                            'created_by': user['username'],
+                            'updated_at': datetime.now().isoformat()
+                        }
+                        
+                        if expiry_date:
+                            item_data['expiry_date'] = expiry_date
+                        
+                        success, result = db.create_inventory_item(item_data)
+                        
+                        if success:
+                            st.success(f"✅ Item '{item_name}' added successfully!")
+                            table_sync.patch('inventory', result)
+                            st.rerun()
+                        else:
+                            st.error(f"❌ Error adding item: {result}")
     
     with tab3:
         st.markdown("#### ✏️ Edit/Delete Inventory Item")
         
-        if not inventory_df.empty:
-            item_to_edit = st.selectbox("Select item to edit/delete", 
-                                       inventory_df['item_name'].unique())
+        if grid_mode or not inventory_df.empty:
+            if grid_mode:
+                item_data = remote_item_picker("Select item to edit/delete", "edit")
+            else:
+                lookup = load_item_lookup(data.version('inventory'), inventory_df)
+                item_id_to_edit = item_picker("Select item to edit/delete", "edit", inventory_df, lookup)
+                item_data = lookup.get(item_id_to_edit) if item_id_to_edit else None
             
-            if item_to_edit:
-                item_data = inventory_df[inventory_df['item_name'] == item_to_edit].iloc[0]
+            if item_data is not None:
+                item_to_edit = item_data['item_name']
                 
                 col1, col2 = st.columns(2)
                 
@@ -764,15 +3607,13 @@ elif selected_tab == "📦 Inventory":
                                                      min_value=0, 
                                                      value=int(current_qty))
                         
-                        locations = ["Main Store", "Lab A", "Lab B", "Cold Room", "Quarantine", "Archive", "Warehouse"]
+                        locations = STORAGE_LOCATIONS
                         current_location = item_data.get('storage_location', 'Main Store')
                         new_location = st.selectbox("Storage Location", 
                                                   locations,
                                                   index=locations.index(current_location) if current_location in locations else 0)
                         
-                        categories = ["Stationery", "Comp/Printer/Accessories", "Miscellaneous", 
-                                     "Electrical Items", "Motor Parts", "Vehicle Parts - Toyota Hilux",
-                                     "Fuel & Lubricants", "Laboratory Items", "Medical Supplies", "Office Equipment"]
+                        categories = ITEM_CATEGORIES
                         current_category = item_data.get('category', 'Miscellaneous')
                         new_category = st.selectbox("Category", 
                                                   categories,
@@ -803,7 +3644,7 @@ elif selected_tab == "📦 Inventory":
                             
                             if success:
                                 st.success("✅ Item updated successfully!")
-                                st.cache_data.clear()
+                                table_sync.patch('inventory', result)
                                 st.rerun()
                             else:
                                 st.error(f"❌ Error updating item: {result}")
@@ -826,7 +3667,7 @@ elif selected_tab == "📦 Inventory":
                         
                         if success:
                             st.success(f"✅ Item '{item_to_edit}' deleted successfully!")
-                            st.cache_data.clear()
+                            table_sync.remove('inventory', [item_data['item_id']])
                             st.rerun()
                         else:
                             st.error(f"❌ Error deleting item: {result}")
@@ -835,14 +3676,20 @@ elif selected_tab == "📦 Inventory":
 elif selected_tab == "📥 Stock In":
     st.markdown('<div class="section-header"><h2>📥 Stock Receipts Management</h2></div>', unsafe_allow_html=True)
     
-    tab1, tab2 = st.tabs(["Record Receipt", "Receipt History"])
+    inventory_df = data['inventory']
+    lookup = load_item_lookup(data.version('inventory'), inventory_df)
+    
+    tab1, tab2, tab3 = st.tabs(["Record Receipt", "Goods Received Note", "Receipt History"])
     
     with tab1:
         st.markdown("#### 📝 Record New Stock Receipt")
         
         # Initialize session state for selected item if not exists
-        if 'receipt_item_idx' not in st.session_state:
-            st.session_state.receipt_item_idx = 0
+        # The picker sits outside the form so each search reruns straight away
+        if not inventory_df.empty:
+            selected_item = item_picker("Select Item*", "receipt", inventory_df, lookup)
+        else:
+            selected_item = None
         
         with st.form("receipt_form", clear_on_submit=True):
             col1, col2 = st.columns(2)
@@ -856,23 +3703,9 @@ elif selected_tab == "📥 Stock In":
             
             with col2:
                 if not inventory_df.empty:
-                    # Create a list of item names for selection
-                    item_names = inventory_df['item_name'].tolist()
-                    
-                    # Item selection without callback
-                    selected_item = st.selectbox(
-                        "Select Item*", 
-                        item_names,
-                        index=st.session_state.receipt_item_idx
-                    )
-                    
-                    # Update session state with current selection
-                    if selected_item:
-                        st.session_state.receipt_item_idx = item_names.index(selected_item)
-                    
                     # Get current stock for selected item
                     if selected_item:
-                        item_data = inventory_df[inventory_df['item_name'] == selected_item].iloc[0]
+                        item_data = lookup.get(selected_item)
                         current_stock = int(item_data.get('quantity', 0))  # Convert to Python int
                         unit = item_data.get('unit', 'units')
                         st.info(f"**Current Stock:** {current_stock} {unit}")
@@ -881,7 +3714,6 @@ elif selected_tab == "📥 Stock In":
                         unit = 'units'
                 else:
                     st.warning("No items in inventory. Please add items first.")
-                    selected_item = None
                     current_stock = 0
                     unit = 'units'
                 
@@ -903,106 +3735,158 @@ elif selected_tab == "📥 Stock In":
                 elif selected_item is None:
                     st.error("No item selected!")
                 else:
-                    # Get fresh item data
-                    item_data = inventory_df[inventory_df['item_name'] == selected_item].iloc[0]
+                    item_data = lookup.get(selected_item)
                     
-                    # Update inventory - convert numpy types to Python native types
-                    new_quantity = int(current_stock) + int(quantity)
-                    updates = {
-                        'quantity': new_quantity,  # Already converted to Python int
-                        'updated_at': datetime.now().isoformat(),
-                        'updated_by': str(user['username'])  # Ensure string
+                    # Convert all numpy types to Python native types
+                    receipt_data = {
+                        'date': receipt_date.isoformat(),
+                        'item_id': str(item_data['item_id']),
+                        'item_name': str(item_data['item_name']),
+                        'supplier': str(supplier),
+                        'quantity': int(quantity),
+                        'unit_cost': float(unit_cost),  # Convert to Python float
+                        'total_value': float(total_value),  # Convert to Python float
+                        'project_code': str(project_code),
+                        'reference': str(reference) if reference else '',
+                        'received_by': str(received_by),
+                        'notes': str(notes) if notes else '',
+                        'created_at': datetime.now().isoformat()
                     }
                     
-                    success, result = db.update_inventory_item(str(item_data['item_id']), updates)
+                    # Quantity change and ledger row are applied in one transaction
+                    status, result = submit_stock_movements('receipt', [receipt_data], str(user['username']))
                     
-                    if success:
-                        # Add to receipts - convert all numpy types to Python native types
-                        receipt_data = {
-                            'date': receipt_date.isoformat(),
-                            'item_id': str(item_data['item_id']),
-                            'item_name': str(selected_item),
-                            'supplier': str(supplier),
-                            'quantity': int(quantity),
-                            'unit_cost': float(unit_cost),  # Convert to Python float
-                            'total_value': float(total_value),  # Convert to Python float
-                            'project_code': str(project_code),
-                            'reference': str(reference) if reference else '',
-                            'received_by': str(received_by),
-                            'notes': str(notes) if notes else '',
-                            'created_at': datetime.now().isoformat()
-                        }
+                    if status == 'recorded':
+                        st.success(f"✅ Receipt recorded successfully! Stock updated to {result['items'][0]['quantity']} units.")
+                        st.rerun()
+                    elif status == 'queued':
+                        st.info("📤 The stores database is unreachable. The receipt was saved on this "
+                                "computer and will sync automatically when the connection returns.")
+                    else:
+                        st.error(f"❌ Error recording receipt: {result}")
+    
+    with tab2:
+        st.markdown("#### 🧾 Multi-line Goods Received Note")
+        
+        if inventory_df.empty:
+            st.warning("No items in inventory. Please add items first.")
+        else:
+            grn_lines = voucher_lines_editor(
+                "grn", inventory_df, lookup,
+                {'quantity': st.column_config.NumberColumn("Quantity*", min_value=1, step=1),
+                 'unit_cost': st.column_config.NumberColumn("Unit Cost (GHS)*", min_value=0.0, format="%.2f")},
+                {'quantity': 1, 'unit_cost': 0.0}
+            )
+            
+            with st.form("grn_form", clear_on_submit=True):
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    grn_date = st.date_input("Date Received*", value=datetime.now(), key="grn_date")
+                    grn_supplier = st.text_input("Supplier Name*", placeholder="e.g., Office Supplies Ltd.", key="grn_supplier")
+                    grn_project = st.selectbox("Project/Source of Funds", 
+                                             ["General Funds", "Research Grant A", "Research Grant B", "Donor Funds", "Other"],
+                                             key="grn_project")
+                
+                with col2:
+                    grn_reference = st.text_input("Delivery Note/Invoice No.", placeholder="DN-2024-001", key="grn_reference")
+                    grn_received_by = st.text_input("Received By*", value=user['full_name'], key="grn_received_by")
+                    grn_notes = st.text_input("Notes", key="grn_notes")
+                
+                submitted = st.form_submit_button("📥 Record All Lines", type="primary")
+                
+                if submitted:
+                    lines, errors = validate_movement_lines('receipt', grn_lines, lookup)
+                    if not all([grn_supplier, grn_received_by]):
+                        errors.insert(0, "Please fill all required fields (*)!")
+                    
+                    if errors:
+                        st.error("\n".join(f"- {error}" for error in errors))
+                    else:
+                        entries = lines.assign(
+                            date=grn_date.isoformat(),
+                            supplier=grn_supplier,
+                            project_code=grn_project,
+                            reference=grn_reference or '',
+                            received_by=grn_received_by,
+                            notes=grn_notes or '',
+                            created_at=datetime.now().isoformat()
+                        )[['date', 'item_id', 'item_name', 'supplier', 'quantity', 'unit_cost', 'total_value',
+                           'project_code', 'reference', 'received_by', 'notes', 'created_at']].to_dict('records')
                         
-                        success2, result2 = db.create_receipt(receipt_data)
+                        # All quantity deltas and ledger rows commit together or not at all
+                        status, result = submit_stock_movements('receipt', entries, str(user['username']))
                         
-                        if success2:
-                            st.success(f"✅ Receipt recorded successfully! Stock updated to {new_quantity} units.")
-                            st.cache_data.clear()
+                        if status == 'recorded':
+                            st.success(f"✅ Goods received note recorded: {len(entries)} lines, "
+                                       f"GHS {lines['total_value'].sum():,.2f}.")
+                            clear_voucher_lines("grn")
                             st.rerun()
+                        elif status == 'queued':
+                            st.info("📤 The stores database is unreachable. The goods received note was saved on this "
+                                    "computer and will sync automatically when the connection returns.")
+                            clear_voucher_lines("grn")
                         else:
-                            st.error(f"❌ Error recording receipt: {result2}")
-                    else:
-                        st.error(f"❌ Error updating inventory: {result}")
+                            st.error(f"❌ Error recording goods received note: {result}")
     
-    with tab2:
+    with tab3:
         st.markdown("#### 📋 Receipt History")
         
-        if not receipts_df.empty:
-            col1, col2 = st.columns(2)
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("From Date", key="receipt_start", value=datetime.now() - timedelta(days=30))
+        with col2:
+            end_date = st.date_input("To Date", key="receipt_end", value=datetime.now())
+        
+        # Only the selected window is fetched from the database
+        filtered_receipts = load_receipts_window(start_date, end_date, table_sync.version('receipts'))
+        
+        if not filtered_receipts.empty:
+            total_receipts = len(filtered_receipts)
+            total_quantity = int(filtered_receipts['quantity'].sum())  # Convert to Python int
+            total_value = float(filtered_receipts['total_value'].sum())  # Convert to Python float
+            
+            col1, col2, col3 = st.columns(3)
             with col1:
-                start_date = st.date_input("From Date", key="receipt_start", value=datetime.now() - timedelta(days=30))
+                st.metric("Total Receipts", total_receipts)
             with col2:
-                end_date = st.date_input("To Date", key="receipt_end", value=datetime.now())
+                st.metric("Total Quantity", f"{total_quantity:,}")
+            with col3:
+                st.metric("Total Value", f"GHS {total_value:,.2f}")
             
-            # Convert dates for filtering
-            filtered_receipts = receipts_df.copy()
-            filtered_receipts['date'] = pd.to_datetime(filtered_receipts['date'], errors='coerce')
-            mask = (filtered_receipts['date'] >= pd.Timestamp(start_date)) & \
-                   (filtered_receipts['date'] <= pd.Timestamp(end_date))
-            filtered_receipts = filtered_receipts[mask]
+            display_df = filtered_receipts.copy()
+            display_df['date'] = pd.to_datetime(display_df['date']).dt.strftime('%Y-%m-%d')
             
-            if not filtered_receipts.empty:
-                total_receipts = len(filtered_receipts)
-                total_quantity = int(filtered_receipts['quantity'].sum())  # Convert to Python int
-                total_value = float(filtered_receipts['total_value'].sum())  # Convert to Python float
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Receipts", total_receipts)
-                with col2:
-                    st.metric("Total Quantity", f"{total_quantity:,}")
-                with col3:
-                    st.metric("Total Value", f"GHS {total_value:,.2f}")
-                
-                display_df = filtered_receipts.copy()
-                display_df['date'] = pd.to_datetime(display_df['date']).dt.strftime('%Y-%m-%d')
-                
-                st.dataframe(display_df, use_container_width=True)
-                
-                csv = filtered_receipts.to_csv(index=False)
-                st.download_button(
-                    "📥 Export Receipts",
-                    data=csv,
-                    file_name=f"receipts_{start_date}_to_{end_date}.csv",
-                    mime="text/csv"
-                )
-            else:
-                st.info("No receipts found for the selected period.")
+            st.dataframe(display_df, use_container_width=True)
+            
+            csv = filtered_receipts.to_csv(index=False)
+            st.download_button(
+                "📥 Export Receipts",
+                data=csv,
+                file_name=f"receipts_{start_date}_to_{end_date}.csv",
+                mime="text/csv"
+            )
         else:
-            st.info("No receipts recorded yet.")
+            st.info("No receipts found for the selected period.")
 
 # STOCK OUT TAB
 elif selected_tab == "📤 Stock Out":
     st.markdown('<div class="section-header"><h2>📤 Stock Issues Management</h2></div>', unsafe_allow_html=True)
     
-    tab1, tab2 = st.tabs(["Issue Stock", "Issue History"])
+    inventory_df = data['inventory']
+    lookup = load_item_lookup(data.version('inventory'), inventory_df)
+    
+    tab1, tab2, tab3 = st.tabs(["Issue Stock", "Issue Voucher", "Issue History"])
     
     with tab1:
         st.markdown("#### 📝 Issue Stock to Department")
         
         # Initialize session state for selected item if not exists
-        if 'issue_item_idx' not in st.session_state:
-            st.session_state.issue_item_idx = 0
+        # The picker sits outside the form so each search reruns straight away
+        if not inventory_df.empty:
+            selected_item = item_picker("Select Item*", "issue", inventory_df, lookup)
+        else:
+            selected_item = None
         
         with st.form("issue_form", clear_on_submit=True):
             col1, col2 = st.columns(2)
@@ -1016,23 +3900,9 @@ elif selected_tab == "📤 Stock Out":
             
             with col2:
                 if not inventory_df.empty:
-                    # Create a list of item names for selection
-                    item_names = inventory_df['item_name'].tolist()
-                    
-                    # Item selection without callback
-                    selected_item = st.selectbox(
-                        "Select Item*", 
-                        item_names,
-                        index=st.session_state.issue_item_idx
-                    )
-                    
-                    # Update session state with current selection
-                    if selected_item:
-                        st.session_state.issue_item_idx = item_names.index(selected_item)
-                    
                     # Get current stock for selected item
                     if selected_item:
-                        item_data = inventory_df[inventory_df['item_name'] == selected_item].iloc[0]
+                        item_data = lookup.get(selected_item)
                         current_stock = int(item_data.get('quantity', 0))  # Convert to Python int
                         unit = item_data.get('unit', 'units')
                         st.info(f"**Current Stock:** {current_stock} {unit}")
@@ -1045,7 +3915,6 @@ elif selected_tab == "📤 Stock Out":
                         max_quantity = 0
                 else:
                     st.warning("No items in inventory. Please add items first.")
-                    selected_item = None
                     current_stock = 0
                     unit = 'units'
                     max_quantity = 0
@@ -1071,132 +3940,168 @@ elif selected_tab == "📤 Stock Out":
                 elif quantity > current_stock:
                     st.error(f"Cannot issue {quantity} units. Only {current_stock} available!")
                 else:
-                    # Get fresh item data
-                    item_data = inventory_df[inventory_df['item_name'] == selected_item].iloc[0]
+                    item_data = lookup.get(selected_item)
                     
-                    # Update inventory - convert numpy types to Python native types
-                    new_quantity = int(current_stock) - int(quantity)
-                    updates = {
-                        'quantity': new_quantity,  # Already converted to Python int
-                        'updated_at': datetime.now().isoformat(),
-                        'updated_by': str(user['username'])  # Ensure string
+                    # Convert all numpy types to Python native types
+                    issue_data = {
+                        'date': issue_date.isoformat(),
+                        'item_id': str(item_data['item_id']),
+                        'item_name': str(item_data['item_name']),
+                        'department': str(department),
+                        'quantity': int(quantity),
+                        'purpose': str(purpose) if purpose else '',
+                        'issued_by': str(issued_by),
+                        'notes': str(notes) if notes else '',
+                        'created_at': datetime.now().isoformat()
                     }
                     
-                    success, result = db.update_inventory_item(str(item_data['item_id']), updates)
+                    # The database rejects the issue if it would take stock below zero
+                    status, result = submit_stock_movements('issue', [issue_data], str(user['username']))
                     
-                    if success:
-                        # Add to issues - convert all numpy types to Python native types
-                        issue_data = {
-                            'date': issue_date.isoformat(),
-                            'item_id': str(item_data['item_id']),
-                            'item_name': str(selected_item),
-                            'department': str(department),
-                            'quantity': int(quantity),
-                            'purpose': str(purpose) if purpose else '',
-                            'issued_by': str(issued_by),
-                            'notes': str(notes) if notes else '',
-                            'created_at': datetime.now().isoformat()
-                        }
+                    if status == 'recorded':
+                        st.success(f"✅ Stock issued successfully! Remaining stock: {result['items'][0]['quantity']} units.")
+                        st.rerun()
+                    elif status == 'queued':
+                        st.info("📤 The stores database is unreachable. The issue was saved on this "
+                                "computer and will sync automatically when the connection returns.")
+                    else:
+                        st.error(f"❌ Error recording issue: {result}")
+    
+    with tab2:
+        st.markdown("#### 🧾 Multi-line Issue Voucher")
+        
+        if inventory_df.empty:
+            st.warning("No items in inventory. Please add items first.")
+        else:
+            voucher_lines = voucher_lines_editor(
+                "voucher", inventory_df, lookup,
+                {'quantity': st.column_config.NumberColumn("Quantity*", min_value=1, step=1)},
+                {'quantity': 1}
+            )
+            
+            with st.form("voucher_form", clear_on_submit=True):
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    voucher_date = st.date_input("Issue Date*", value=datetime.now(), key="voucher_date")
+                    voucher_department = st.selectbox("Receiving Department*", 
+                                                    ["Biomedical", "Microbiology", "Parasitology", 
+                                                     "Clinical Lab", "Research", "Administration", "IT", "Field Team", "Maintenance"],
+                                                    key="voucher_department")
+                    voucher_purpose = st.text_input("Purpose/Project", placeholder="e.g., Research Project, Daily Operations",
+                                                    key="voucher_purpose")
+                
+                with col2:
+                    voucher_issued_by = st.text_input("Issued By*", value=user['full_name'], key="voucher_issued_by")
+                    voucher_notes = st.text_input("Notes", key="voucher_notes")
+                
+                submitted = st.form_submit_button("📤 Issue All Lines", type="primary")
+                
+                if submitted:
+                    lines, errors = validate_movement_lines('issue', voucher_lines, lookup)
+                    if not all([voucher_department, voucher_issued_by]):
+                        errors.insert(0, "Please fill all required fields (*)!")
+                    
+                    if errors:
+                        st.error("\n".join(f"- {error}" for error in errors))
+                    else:
+                        entries = lines.assign(
+                            date=voucher_date.isoformat(),
+                            department=voucher_department,
+                            purpose=voucher_purpose or '',
+                            issued_by=voucher_issued_by,
+                            notes=voucher_notes or '',
+                            created_at=datetime.now().isoformat()
+                        )[['date', 'item_id', 'item_name', 'department', 'quantity', 'purpose', 'issued_by',
+                           'notes', 'created_at']].to_dict('records')
                         
-                        success2, result2 = db.create_issue(issue_data)
+                        # The database re-checks every balance inside the transaction
+                        status, result = submit_stock_movements('issue', entries, str(user['username']))
                         
-                        if success2:
-                            st.success(f"✅ Stock issued successfully! Remaining stock: {new_quantity} units.")
-                            st.cache_data.clear()
+                        if status == 'recorded':
+                            st.success(f"✅ Issue voucher recorded: {len(entries)} lines.")
+                            clear_voucher_lines("voucher")
                             st.rerun()
+                        elif status == 'queued':
+                            st.info("📤 The stores database is unreachable. The issue voucher was saved on this "
+                                    "computer and will sync automatically when the connection returns.")
+                            clear_voucher_lines("voucher")
                         else:
-                            st.error(f"❌ Error recording issue: {result2}")
-                    else:
-                        st.error(f"❌ Error updating inventory: {result}")
+                            st.error(f"❌ Error recording issue voucher: {result}")
     
-    with tab2:
+    with tab3:
         st.markdown("#### 📋 Issue History")
         
-        if not issues_df.empty:
-            col1, col2 = st.columns(2)
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("From Date", key="issue_start", value=datetime.now() - timedelta(days=30))
+        with col2:
+            end_date = st.date_input("To Date", key="issue_end", value=datetime.now())
+        
+        # Only the selected window is fetched from the database
+        filtered_issues = load_issues_window(start_date, end_date, table_sync.version('issues'))
+        
+        if not filtered_issues.empty:
+            total_issues = len(filtered_issues)
+            total_quantity = int(filtered_issues['quantity'].sum())  # Convert to Python int
+            departments = int(filtered_issues['department'].nunique())  # Convert to Python int
+            
+            col1, col2, col3 = st.columns(3)
             with col1:
-                start_date = st.date_input("From Date", key="issue_start", value=datetime.now() - timedelta(days=30))
+                st.metric("Total Issues", total_issues)
             with col2:
-                end_date = st.date_input("To Date", key="issue_end", value=datetime.now())
+                st.metric("Total Quantity", f"{total_quantity:,}")
+            with col3:
+                st.metric("Departments", departments)
             
-            # Convert dates for filtering
-            filtered_issues = issues_df.copy()
-            filtered_issues['date'] = pd.to_datetime(filtered_issues['date'], errors='coerce')
-            mask = (filtered_issues['date'] >= pd.Timestamp(start_date)) & \
-                   (filtered_issues['date'] <= pd.Timestamp(end_date))
-            filtered_issues = filtered_issues[mask]
+            display_df = filtered_issues.copy()
+            display_df['date'] = pd.to_datetime(display_df['date']).dt.strftime('%Y-%m-%d')
             
-            if not filtered_issues.empty:
-                total_issues = len(filtered_issues)
-                total_quantity = int(filtered_issues['quantity'].sum())  # Convert to Python int
-                departments = int(filtered_issues['department'].nunique())  # Convert to Python int
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Issues", total_issues)
-                with col2:
-                    st.metric("Total Quantity", f"{total_quantity:,}")
-                with col3:
-                    st.metric("Departments", departments)
-                
-                display_df = filtered_issues.copy()
-                display_df['date'] = pd.to_datetime(display_df['date']).dt.strftime('%Y-%m-%d')
-                
-                st.dataframe(display_df, use_container_width=True)
-                
-                csv = filtered_issues.to_csv(index=False)
-                st.download_button(
-                    "📥 Export Issues",
-                    data=csv,
-                    file_name=f"issues_{start_date}_to_{end_date}.csv",
-                    mime="text/csv"
-                )
-            else:
-                st.info("No issues found for the selected period.")
+            st.dataframe(display_df, use_container_width=True)
+            
+            csv = filtered_issues.to_csv(index=False)
+            st.download_button(
+                "📥 Export Issues",
+                data=csv,
+                file_name=f"issues_{start_date}_to_{end_date}.csv",
+                mime="text/csv"
+            )
         else:
-            st.info("No issues recorded yet.")
+            st.info("No issues found for the selected period.")
 
 # EXPIRY TAB
 elif selected_tab == "⏰ Expiry":
     st.markdown('<div class="section-header"><h2>⏰ Expiry Management</h2></div>', unsafe_allow_html=True)
     
+    inventory_df = data['inventory']
+    
     if not inventory_df.empty and 'expiry_date' in inventory_df.columns:
-        inventory_df['expiry_date_dt'] = pd.to_datetime(inventory_df['expiry_date'], errors='coerce')
-        current_date = pd.Timestamp.now()
-        inventory_df['days_to_expiry'] = (inventory_df['expiry_date_dt'] - current_date).dt.days
-        
-        expiry_items = inventory_df[pd.notna(inventory_df['expiry_date'])]
+        # Expiry buckets are precomputed when the inventory table is loaded
+        expiry_items = inventory_df[inventory_df['expiry_status'] != NO_EXPIRY]
         
         if not expiry_items.empty:
             col1, col2, col3, col4 = st.columns(4)
             
-            expired = (expiry_items['days_to_expiry'] <= 0).sum()
-            expiring_30 = ((expiry_items['days_to_expiry'] > 0) & 
-                          (expiry_items['days_to_expiry'] <= 30)).sum()
-            expiring_90 = ((expiry_items['days_to_expiry'] > 30) & 
-                          (expiry_items['days_to_expiry'] <= 90)).sum()
-            expiring_180 = ((expiry_items['days_to_expiry'] > 90) & 
-                           (expiry_items['days_to_expiry'] <= 180)).sum()
+            bucket_counts = expiry_items['expiry_status'].value_counts()
             
             with col1:
-                st.metric("Expired", expired)
+                st.metric("Expired", int(bucket_counts["Expired"]))
             with col2:
-                st.metric("< 30 Days", expiring_30)
+                st.metric("< 30 Days", int(bucket_counts["≤ 30 Days"]))
             with col3:
-                st.metric("30-90 Days", expiring_90)
+                st.metric("30-90 Days", int(bucket_counts["31-90 Days"]))
             with col4:
-                st.metric("90-180 Days", expiring_180)
+                st.metric("90-180 Days", int(bucket_counts["91-180 Days"]))
             
             st.markdown("#### 🚨 Expired Items")
-            expired_items = expiry_items[expiry_items['days_to_expiry'] <= 0]
+            expired_items = expiry_items[expiry_items['expiry_status'] == "Expired"]
             if not expired_items.empty:
                 st.dataframe(expired_items[['item_name', 'category', 'quantity', 'unit', 'expiry_date']], use_container_width=True)
             else:
                 st.success("✅ No expired items!")
             
             st.markdown("#### ⚠️ Items Expiring Soon (≤ 30 days)")
-            expiring_soon = expiry_items[(expiry_items['days_to_expiry'] > 0) & 
-                                         (expiry_items['days_to_expiry'] <= 30)]
+            expiring_soon = expiry_items[expiry_items['expiry_status'] == "≤ 30 Days"]
             if not expiring_soon.empty:
                 st.dataframe(expiring_soon[['item_name', 'category', 'quantity', 'unit', 'expiry_date', 'days_to_expiry']].sort_values('days_to_expiry'), use_container_width=True)
             else:
@@ -1215,19 +4120,19 @@ elif selected_tab == "📝 Reports":
     with tab1:
         st.markdown("#### 📅 Stores Summary Report")
         
+        kpis = load_inventory_kpis(table_sync.version('inventory'))
+        movement_totals = load_movement_totals(table_sync.version('receipts'), table_sync.version('issues'))
+        
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Total Items", len(inventory_df) if not inventory_df.empty else 0)
+            st.metric("Total Items", kpis['total_items'])
         with col2:
-            total_units = inventory_df['quantity'].sum() if not inventory_df.empty and 'quantity' in inventory_df.columns else 0
-            st.metric("Total Units", f"{total_units:,}")
+            st.metric("Total Units", f"{kpis['total_units']:,}")
         with col3:
-            total_receipts = receipts_df['quantity'].sum() if not receipts_df.empty and 'quantity' in receipts_df.columns else 0
-            st.metric("Total Received", f"{total_receipts:,}")
+            st.metric("Total Received", f"{movement_totals['total_received']:,}")
         with col4:
-            total_issues = issues_df['quantity'].sum() if not issues_df.empty and 'quantity' in issues_df.columns else 0
-            st.metric("Total Issued", f"{total_issues:,}")
+            st.metric("Total Issued", f"{movement_totals['total_issued']:,}")
         
         if st.button("🔄 Generate Report", type="primary"):
             st.success("Report generated successfully!")
@@ -1235,40 +4140,25 @@ elif selected_tab == "📝 Reports":
     with tab2:
         st.markdown("#### 📤 Export Data")
         
-        col1, col2, col3 = st.columns(3)
-        
-        with col1:
-            if not inventory_df.empty:
-                csv = inventory_df.to_csv(index=False)
-                st.download_button(
-                    "📦 Export Inventory",
-                    data=csv,
-                    file_name="inventory_data.csv",
-                    mime="text/csv",
-                    use_container_width=True
-                )
-        
-        with col2:
-            if not receipts_df.empty:
-                csv = receipts_df.to_csv(index=False)
-                st.download_button(
-                    "📥 Export Receipts",
-                    data=csv,
-                    file_name="receipts_data.csv",
-                    mime="text/csv",
-                    use_container_width=True
-                )
-        
-        with col3:
-            if not issues_df.empty:
-                csv = issues_df.to_csv(index=False)
-                st.download_button(
-                    "📤 Export Issues",
-                    data=csv,
-                    file_name="issues_data.csv",
-                    mime="text/csv",
-                    use_container_width=True
-                )
+        # The ledgers grow without bound, so each table is only fetched when its export is asked for
+        exports = [("📦 Export Inventory", 'inventory'), ("📥 Export Receipts", 'receipts'),
+                   ("📤 Export Issues", 'issues')]
+        for col, (label, table) in zip(st.columns(3), exports):
+            with col:
+                if st.button(label, use_container_width=True):
+                    with st.spinner(f"Exporting {table}..."):
+                        csv = export_table(table)
+                    if csv:
+                        st.download_button(
+                            f"💾 Download {table}_data.csv",
+                            data=csv,
+                            file_name=f"{table}_data.csv",
+                            mime="text/csv",
+                            use_container_width=True,
+                            on_click="ignore"
+                        )
+                    elif csv is not None:
+                        st.info(f"No {table} to export.")
 
 # SETTINGS TAB (Admin only)
 elif selected_tab == "⚙️ Settings":
@@ -1279,12 +4169,12 @@ elif selected_tab == "⚙️ Settings":
     
     st.markdown('<div class="section-header"><h2>⚙️ System Settings</h2></div>', unsafe_allow_html=True)
     
-    tab1, tab2 = st.tabs(["User Management", "System Info"])
+    tab1, tab2, tab3 = st.tabs(["User Management", "Bulk Import", "System Info"])
     
     with tab1:
         st.markdown("#### 👥 User Management")
         
-        users_df = db.get_users()
+        users_df = auth.users.get_users()
         
         st.markdown("##### 📋 All System Users")
         
@@ -1334,25 +4224,137 @@ elif selected_tab == "⚙️ Settings":
                         st.error(f"❌ {message}")
     
     with tab2:
+        st.markdown("#### 📂 Bulk Import")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            import_target = st.radio("Import into", ["Inventory", "Users"], horizontal=True)
+            chunk_size = st.number_input("Rows per chunk", min_value=50, max_value=5000, value=500, step=50)
+        with col2:
+            bundled_file = "Stores Data.xlsx" if import_target == "Inventory" else "store_users.csv"
+            uploaded = st.file_uploader("Workbook or CSV", type=["xlsx", "csv"])
+            st.caption(f"Leave empty to import the bundled {bundled_file}.")
+        
+        bundled_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), bundled_file)
+        if uploaded is not None:
+            import_data, import_name = uploaded.getvalue(), uploaded.name
+        elif os.path.exists(bundled_path):
+            with open(bundled_path, 'rb') as f:
+                import_data, import_name = f.read(), bundled_file
+        else:
+            import_data, import_name = None, None
+        
+        if import_data is None:
+            st.info("Upload a file to import.")
+        else:
+            if import_target == "Inventory":
+                importer = InventoryImporter(db, chunk_size, username=user['username'], id_allocator=item_id_allocator)
+                existing = data['inventory']
+            else:
+                importer = UserImporter(db, chunk_size, username=user['username'])
+                existing = auth.users.get_users()
+            
+            if importer.has_checkpoint(import_data):
+                st.info(f"A previous import of {import_name} stopped part-way. Importing will resume it.")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                dry_run = st.button("🔎 Dry Run", use_container_width=True)
+            with col2:
+                run_import = st.button("📥 Import", type="primary", use_container_width=True)
+            
+            if dry_run or run_import:
+                progress = st.progress(0.0)
+                with st.spinner(f"Processing {import_name}..."):
+                    report = importer.run(import_data, import_name, existing, dry_run=dry_run,
+                                          progress=progress.progress)
+                
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("Rows Read", report['rows_read'])
+                with col2:
+                    st.metric("New", report['to_insert'])
+                with col3:
+                    st.metric("Updates", report['to_update'])
+                with col4:
+                    st.metric("Rejected", report['rejected'])
+                
+                if report['error']:
+                    st.error(f"❌ {report['error']}. Run the import again to resume from there.")
+                elif run_import:
+                    st.success(f"✅ Imported {report['imported']} rows in {report['chunks']} chunks.")
+                    if import_target == "Inventory":
+                        table_sync.patch('inventory', report['written'])
+                    else:
+                        auth.users.invalidate()
+                else:
+                    st.info(f"Dry run only: {report['chunks']} chunks would be written.")
+                
+                if not report['issues'].empty:
+                    st.markdown("##### Validation Report")
+                    st.dataframe(report['issues'], use_container_width=True)
+    
+    with tab3:
         st.markdown("#### ℹ️ System Information")
         
+        kpis = load_inventory_kpis(table_sync.version('inventory'))
+        movement_totals = load_movement_totals(table_sync.version('receipts'), table_sync.version('issues'))
+        
         st.info(f"""
         **System Details:**
         - **Version:** 2.0.0 (Supabase Edition)
         - **Last Updated:** {datetime.now().strftime('%Y-%m-%d')}
-        - **Database:** Supabase (PostgreSQL)
+        - **Database:** {db.NAME or type(db).__name__}
         - **Total Users:** {len(users_df) if not users_df.empty else 0}
         
         **Inventory Statistics:**
-        - Total Items: {len(inventory_df)}
-        - Total Categories: {inventory_df['category'].nunique() if not inventory_df.empty and 'category' in inventory_df.columns else 0}
-        - Total Receipts: {len(receipts_df)}
-        - Total Issues: {len(issues_df)}
+        - Total Items: {kpis['total_items']}
+        - Total Categories: {kpis['categories']}
+        - Total Receipts: {movement_totals['receipt_count']}
+        - Total Issues: {movement_totals['issue_count']}
         
         **Support Contact:**
         - Email: f.amengaetego@gmail.com
         - Phone: +233 54 754 8200
         """)
+        
+        transport_stats = db.get_transport_stats()
+        if not transport_stats.empty:
+            with st.expander("📡 Backend Latency (this server process)"):
+                st.dataframe(transport_stats, use_container_width=True, hide_index=True)
+        
+        store_stats = frame_store.stats()
+        st.caption(f"Shared derived frames: {store_stats['frames']} held, "
+                   f"{store_stats['used_mb']:.1f} of {store_stats['budget_mb']:.0f} MB")
+        
+        queued_df = outbox.get_entries()
+        if not queued_df.empty:
+            st.markdown("#### 📤 Offline Movement Queue")
+            st.dataframe(queued_df[['queued_at', 'kind', 'date', 'item_id', 'item_name', 'quantity',
+                                    'username', 'status', 'attempts', 'last_error']],
+                         use_container_width=True)
+            
+            if (queued_df['status'] == 'failed').any():
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button("🔁 Retry Rejected Lines", use_container_width=True):
+                        outbox.retry_failed()
+                        st.rerun()
+                with col2:
+                    if st.button("🗑️ Discard Rejected Lines", use_container_width=True):
+                        outbox.discard_failed()
+                        st.rerun()
+
+# ========== DATA FRESHNESS ==========
+as_of, from_snapshot, refreshing = table_sync.freshness()
+if as_of is not None:
+    age = datetime.now() - as_of
+    age_text = f"{int(age.total_seconds() // 60)} min ago" if age >= timedelta(minutes=1) else "just now"
+    if from_snapshot:
+        freshness_slot.caption(f"🟡 Offline snapshot from {as_of:%d %b %H:%M} ({age_text})"
+                               f"{' · refreshing…' if refreshing else ''}")
+    else:
+        freshness_slot.caption(f"🟢 Data synced {age_text}")
 
 # ========== FOOTER ==========
 st.markdown("---")
@@ -0,0 +1,40 @@
+-- Aggregate views used by the Dashboard and Reports tabs.
+-- Run once in the Supabase SQL editor. The app falls back to computing the
+-- same numbers in pandas when these views are missing.
+
+-- Days to expiry follow pandas' (expiry - now).dt.days, i.e. floored whole days.
+create or replace view inventory_kpis as
+with expiry as (
+    select quantity,
+           reorder_level,
+           category,
+           floor(extract(epoch from (expiry_date::timestamp - localtimestamp)) / 86400) as days_to_expiry
+    from inventory
+)
+select count(*)                                                          as total_items,
+       coalesce(sum(quantity), 0)                                        as total_units,
+       count(*) filter (where quantity <= reorder_level and quantity > 0) as low_stock,
+       count(*) filter (where days_to_expiry <= 0)                        as expired,
+       count(*) filter (where days_to_expiry > 0 and days_to_expiry <= 30) as expiring_30,
+       count(distinct category)                                          as categories
+from expiry;
+
+create or replace view inventory_category_totals as
+select category,
+       coalesce(sum(quantity), 0) as quantity,
+       count(*)                   as items
+from inventory
+group by category
+order by category;
+
+create or replace view inventory_low_stock as
+select item_name, category, quantity, unit, reorder_level
+from inventory
+where quantity <= reorder_level
+order by quantity, item_name;
+
+create or replace view movement_totals as
+select (select coalesce(sum(quantity), 0) from receipts) as total_received,
+       (select coalesce(sum(quantity), 0) from issues)   as total_issued,
+       (select count(*) from receipts)                   as receipt_count,
+       (select count(*) from issues)                     as issue_count;
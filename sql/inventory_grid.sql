@@ -0,0 +1,34 @@
+-- Paged inventory grid: the View Inventory tab filters, sorts and pages this view
+-- with PostgREST when the store holds more than SMIS_GRID_THRESHOLD items.
+-- Run once in the Supabase SQL editor. The app falls back to paging the cached
+-- inventory in pandas when the view is missing.
+
+-- Stock status and expiry bucket follow enrich_inventory in app4.py: days to expiry
+-- are floored whole days, and buckets are (lower, upper] ranges.
+create or replace view inventory_grid as
+with expiry as (
+    select inventory.*,
+           floor(extract(epoch from (expiry_date::timestamp - localtimestamp)) / 86400) as days_to_expiry
+    from inventory
+)
+select expiry.*,
+       case
+           when quantity <= 0 then 'Critical'
+           when quantity <= reorder_level then 'Low'
+           else 'Adequate'
+       end as stock_status,
+       case
+           when days_to_expiry is null then 'No Expiry'
+           when days_to_expiry <= 0 then 'Expired'
+           when days_to_expiry <= 30 then '≤ 30 Days'
+           when days_to_expiry <= 90 then '31-90 Days'
+           when days_to_expiry <= 180 then '91-180 Days'
+           else '> 180 Days'
+       end as expiry_status
+from expiry;
+
+-- Sort and filter columns of the grid; item_id is the tie-breaker of every sort
+create index if not exists inventory_item_name_idx on inventory (item_name, item_id);
+create index if not exists inventory_category_idx on inventory (category, item_id);
+create index if not exists inventory_quantity_idx on inventory (quantity, item_id);
+create index if not exists inventory_expiry_date_idx on inventory (expiry_date, item_id);
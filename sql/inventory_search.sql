@@ -0,0 +1,9 @@
+-- Trigram indexes for the type-ahead item picker, which filters inventory with
+-- item_name/item_id ILIKE '%term%' and a small LIMIT on every search.
+-- Run once in the Supabase SQL editor. Without them the search still works,
+-- with a sequential scan of the inventory table.
+
+create extension if not exists pg_trgm;
+
+create index if not exists inventory_item_name_trgm on inventory using gin (item_name gin_trgm_ops);
+create index if not exists inventory_item_id_trgm on inventory using gin (item_id gin_trgm_ops);
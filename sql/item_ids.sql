@@ -0,0 +1,39 @@
+-- Collision-free item IDs: one counter per STR-<CAT>-<date>- prefix, bumped under
+-- a row lock, so concurrent clerks and bulk imports never receive the same number.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists id_counters (
+    prefix     text primary key,
+    last_value bigint not null
+);
+
+-- Reserves p_count consecutive numbers under p_prefix and returns the first one.
+-- Numbers already used by existing item IDs (e.g. given explicitly in an import)
+-- are skipped.
+create or replace function allocate_id_block(p_prefix text, p_count integer)
+returns bigint
+language plpgsql
+as $$
+declare
+    v_last bigint;
+    v_used bigint;
+begin
+    if p_count < 1 then
+        raise exception 'Block size must be at least 1';
+    end if;
+    
+    insert into id_counters (prefix, last_value) values (p_prefix, 0)
+    on conflict (prefix) do nothing;
+    -- Serialises allocations for this prefix until the transaction ends
+    select last_value into v_last from id_counters where prefix = p_prefix for update;
+    
+    select coalesce(max(substring(item_id from length(p_prefix) + 1)::bigint), 0) into v_used
+    from inventory
+    where starts_with(item_id, p_prefix)
+      and substring(item_id from length(p_prefix) + 1) ~ '^[0-9]{1,18}$';
+    
+    v_last := greatest(v_last, v_used) + p_count;
+    update id_counters set last_value = v_last where prefix = p_prefix;
+    return v_last - p_count + 1;
+end;
+$$;
@@ -0,0 +1,12 @@
+-- Signed-out session tokens. Tokens are signed, not stored, so a sign-out has to be
+-- remembered centrally until the token would have expired anyway; every server
+-- process checks this table before resuming a session from its cookie.
+-- Run once in the Supabase SQL editor.
+
+create table if not exists revoked_sessions (
+    token_id   text primary key,
+    -- Unix time the token expires; rows past it are purged on the next sign-out
+    expires_at bigint not null
+);
+
+create index if not exists idx_revoked_sessions_expires_at on revoked_sessions (expires_at);
@@ -0,0 +1,123 @@
+-- Atomic stock movements: the quantity change and its ledger row are written
+-- in one transaction, so concurrent clerks cannot lose updates.
+-- Run once in the Supabase SQL editor.
+
+-- Idempotency keys: the app stamps every ledger line with a client_ref, and lines
+-- already recorded under theirs are skipped, so queued offline vouchers can be
+-- replayed safely after a timeout whose outcome was unknown.
+alter table receipts add column if not exists client_ref text;
+alter table issues add column if not exists client_ref text;
+create unique index if not exists receipts_client_ref_key on receipts (client_ref);
+create unique index if not exists issues_client_ref_key on issues (client_ref);
+
+-- Ledger rows are stamped with the database's write time in created_at, which
+-- delta sync uses as its high-water mark. The time the clerk entered the line is
+-- kept in recorded_at: for an offline voucher replayed later it can lie well
+-- behind what other app servers have already synced past.
+alter table receipts add column if not exists recorded_at timestamptz;
+alter table issues add column if not exists recorded_at timestamptz;
+
+-- Single receipts and issues go through record_stock_movements as one-line
+-- vouchers; the older single-line function is no longer called.
+drop function if exists record_stock_movement(text, jsonb, text);
+
+-- Multi-line goods-received notes and issue vouchers: every quantity delta and
+-- every ledger row in p_entries (a JSON array) commits together or not at all.
+create or replace function record_stock_movements(p_kind text, p_entries jsonb, p_user text)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_missing  text;
+    v_short    text;
+    v_items    jsonb;
+    v_entries  jsonb;
+    v_recorded jsonb;
+begin
+    if p_kind not in ('receipt', 'issue') then
+        raise exception 'Unknown movement kind: %', p_kind;
+    end if;
+    if exists (select 1 from jsonb_array_elements(p_entries) e
+                where coalesce((e->>'quantity')::integer, 0) <= 0) then
+        raise exception 'Quantity must be greater than 0 on every line';
+    end if;
+
+    -- Skip lines already recorded under their client_ref; they are returned as-is
+    if p_kind = 'receipt' then
+        select jsonb_agg(to_jsonb(r.*)) into v_recorded from receipts r
+         where r.client_ref in (select e->>'client_ref' from jsonb_array_elements(p_entries) e);
+    else
+        select jsonb_agg(to_jsonb(i.*)) into v_recorded from issues i
+         where i.client_ref in (select e->>'client_ref' from jsonb_array_elements(p_entries) e);
+    end if;
+    select coalesce(jsonb_agg(e), '[]'::jsonb) into p_entries
+      from jsonb_array_elements(p_entries) e
+     where not exists (select 1 from jsonb_array_elements(coalesce(v_recorded, '[]'::jsonb)) x
+                        where x->>'client_ref' = e->>'client_ref');
+
+    -- Lock the affected items in a stable order to avoid deadlocks between vouchers
+    perform 1 from inventory
+      where item_id in (select e->>'item_id' from jsonb_array_elements(p_entries) e)
+      order by item_id
+      for update;
+
+    select string_agg(d.item_id, ', ') into v_missing
+      from (select distinct e->>'item_id' as item_id from jsonb_array_elements(p_entries) e) d
+     where not exists (select 1 from inventory i where i.item_id = d.item_id);
+    if v_missing is not null then
+        raise exception 'Items not found: %', v_missing;
+    end if;
+
+    if p_kind = 'issue' then
+        select string_agg(format('%s (requested %s, available %s)', d.item_id, d.quantity, i.quantity), ', ')
+          into v_short
+          from (select e->>'item_id' as item_id, sum((e->>'quantity')::integer) as quantity
+                  from jsonb_array_elements(p_entries) e group by 1) d
+          join inventory i on i.item_id = d.item_id
+         where i.quantity < d.quantity;
+        if v_short is not null then
+            raise exception 'Insufficient stock: %', v_short;
+        end if;
+    end if;
+
+    with deltas as (
+        select e->>'item_id' as item_id, sum((e->>'quantity')::integer) as quantity
+          from jsonb_array_elements(p_entries) e group by 1
+    ), updated as (
+        update inventory i
+           set quantity   = i.quantity + case when p_kind = 'receipt' then d.quantity else -d.quantity end,
+               updated_at = now(),
+               updated_by = p_user
+          from deltas d
+         where i.item_id = d.item_id
+        returning i.*
+    )
+    select jsonb_agg(to_jsonb(updated.*)) into v_items from updated;
+
+    if p_kind = 'receipt' then
+        with inserted as (
+            insert into receipts (date, item_id, item_name, supplier, quantity, unit_cost, total_value,
+                                  project_code, reference, received_by, notes, client_ref, recorded_at, created_at)
+            select r.date, r.item_id, r.item_name, r.supplier, r.quantity, r.unit_cost, r.total_value,
+                   r.project_code, r.reference, r.received_by, r.notes, r.client_ref,
+                   coalesce(r.created_at, now()), now()
+              from jsonb_populate_recordset(null::receipts, p_entries) r
+            returning receipts.*
+        )
+        select jsonb_agg(to_jsonb(inserted.*)) into v_entries from inserted;
+    else
+        with inserted as (
+            insert into issues (date, item_id, item_name, department, quantity, purpose, issued_by,
+                                notes, client_ref, recorded_at, created_at)
+            select r.date, r.item_id, r.item_name, r.department, r.quantity, r.purpose, r.issued_by,
+                   r.notes, r.client_ref, coalesce(r.created_at, now()), now()
+              from jsonb_populate_recordset(null::issues, p_entries) r
+            returning issues.*
+        )
+        select jsonb_agg(to_jsonb(inserted.*)) into v_entries from inserted;
+    end if;
+
+    return jsonb_build_object('items', coalesce(v_items, '[]'::jsonb),
+                              'entries', coalesce(v_entries, '[]'::jsonb) || coalesce(v_recorded, '[]'::jsonb));
+end;
+$$;